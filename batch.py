@@ -0,0 +1,283 @@
+"""
+JSONLファイルからイラストを一括生成するバッチCLI
+
+入力ファイルは1行1件のJSONで、以下のどちらかの形式:
+    {"id": "cat01", "input": "猫の女の子が花畑で笑っている"}
+    {"id": "lib01", "prompt_data": {"characterCount": 1, "prompt": "...", "characterPrompts": [...]}}
+
+"id" は省略可能（省略時は行の内容から生成）。IDが重複する場合（同じ内容の行を含む）はエラー。"seed" を指定するとNovelAIに渡す。
+生成結果は出力ディレクトリに <id>.png として保存し、manifest.jsonl に1件ずつ追記する。
+manifest.jsonl がチェックポイントを兼ねるため、中断後に同じコマンドを再実行すると
+成功済みの項目はスキップされる。
+
+使い方:
+    python batch.py prompts.jsonl --output-dir batch_outputs --concurrency 4
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from cancellation import CancellationToken, RequestCancelledError
+from routing import validate_prompt_data
+
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def load_items(input_path: str) -> list:
+    """
+    入力JSONLを読み込み、IDを付与した項目のリストを返す
+
+    Raises:
+        ValueError: JSONが不正・オブジェクトでない場合、IDが重複する場合（出力ファイル名が衝突するため）
+    """
+    items = []
+    # ID → 最初に現れた行番号（大文字・小文字を区別しないファイルシステムでの衝突も検出）
+    seen_ids = {}
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"{input_path}:{line_number} JSON解析エラー: {e}")
+            if not isinstance(item, dict):
+                raise ValueError(
+                    f"{input_path}:{line_number} 各行はJSONオブジェクトである必要があります"
+                )
+            if "input" not in item and "prompt_data" not in item:
+                raise ValueError(
+                    f"{input_path}:{line_number} 'input' か 'prompt_data' が必要です"
+                )
+            if item.get("id"):
+                # ファイル名として使うため、パス区切り等を置き換える
+                item["id"] = re.sub(r"[^\w\-.]", "_", str(item["id"]))
+            else:
+                # 行番号ではなく内容から生成し、入力ファイルの並べ替えに影響されないようにする
+                item["id"] = hashlib.sha1(line.encode("utf-8")).hexdigest()[:12]
+
+            key = item["id"].casefold()
+            if key in seen_ids:
+                raise ValueError(
+                    f"{input_path}:{line_number} IDが{seen_ids[key]}行目と重複しています: "
+                    f"{item['id']}（異なる'id'を指定してください）"
+                )
+            seen_ids[key] = line_number
+            items.append(item)
+    return items
+
+
+def load_completed_ids(manifest_path: str) -> set:
+    """マニフェストから成功済みの項目IDを取得"""
+    completed = set()
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で中断された最終行は無視する
+                continue
+            if isinstance(record, dict) and record.get("status") == "ok":
+                completed.add(record["id"])
+    return completed
+
+
+class BatchRunner:
+    """入力項目をChatGPT → NovelAIの順に処理し、結果を出力ディレクトリに書き出す"""
+
+    def __init__(
+        self,
+        output_dir: str,
+        concurrency: int = 2,
+        novelai_concurrency: int = 1,
+        chatgpt=None,
+        novelai=None,
+    ):
+        self.output_dir = output_dir
+        self.concurrency = concurrency
+        self.chatgpt = chatgpt
+        self.novelai = novelai
+        self.manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+
+        # NovelAIはアカウントごとの同時生成数に制限があるため別枠で制御
+        self._novelai_slots = threading.Semaphore(novelai_concurrency)
+        self._manifest_lock = threading.Lock()
+        self.cancel_token = CancellationToken()
+
+        self.stats = {"ok": 0, "error": 0, "chatgpt_seconds": 0.0, "novelai_seconds": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def _write_manifest(self, record: dict):
+        with self._manifest_lock:
+            with open(self.manifest_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _write_image(self, item_id: str, image_data: bytes) -> str:
+        """画像を一時ファイル経由で書き込み、中断時に壊れたPNGが残らないようにする"""
+        filepath = os.path.join(self.output_dir, f"{item_id}.png")
+        tmp_path = filepath + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(image_data)
+        os.replace(tmp_path, filepath)
+        return filepath
+
+    def process_item(self, item: dict) -> dict:
+        """1項目を処理してマニフェストに記録"""
+        item_id = item["id"]
+        record = {"id": item_id, "input": item.get("input")}
+        try:
+            prompt_data = item.get("prompt_data")
+            if prompt_data is None:
+                if self.chatgpt is None:
+                    raise RuntimeError("ChatGPTが利用できません")
+                start = time.perf_counter()
+                # フォールバックのプロンプトで生成して成功扱いにしないよう、失敗は例外で受け取る
+                prompt_data = self.chatgpt.enhance_illustration_prompt(
+                    item["input"], cancel_token=self.cancel_token, strict=True
+                )
+                record["chatgpt_seconds"] = round(time.perf_counter() - start, 3)
+            record["prompt_data"] = prompt_data
+            if not validate_prompt_data(prompt_data):
+                raise ValueError("構造化プロンプトの形式が不正です")
+
+            kwargs = {}
+            if "seed" in item:
+                kwargs["seed"] = item["seed"]
+                record["seed"] = item["seed"]
+
+            with self._novelai_slots:
+                self.cancel_token.raise_if_cancelled("novelai")
+                start = time.perf_counter()
+                image_data = self.novelai.generate_image(
+                    prompt_data, cancel_token=self.cancel_token, **kwargs
+                )
+                record["novelai_seconds"] = round(time.perf_counter() - start, 3)
+
+            if not image_data:
+                raise RuntimeError("画像生成に失敗しました")
+
+            record["image"] = os.path.basename(self._write_image(item_id, image_data))
+            record["status"] = "ok"
+        except RequestCancelledError:
+            # 中断された項目は記録せず、再実行時に処理し直す
+            raise
+        except Exception as e:
+            record["status"] = "error"
+            record["error"] = str(e)
+
+        record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        self._write_manifest(record)
+
+        with self._stats_lock:
+            self.stats[record["status"]] += 1
+            self.stats["chatgpt_seconds"] += record.get("chatgpt_seconds", 0.0)
+            self.stats["novelai_seconds"] += record.get("novelai_seconds", 0.0)
+        return record
+
+    def run(self, items: list) -> dict:
+        """未完了の項目を並行処理し、スループットを返す"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        completed = load_completed_ids(self.manifest_path)
+        pending = [item for item in items if item["id"] not in completed]
+        print(
+            f"📋 全{len(items)}件 / 完了済み{len(items) - len(pending)}件 / 処理対象{len(pending)}件"
+        )
+
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="batch"
+        )
+        try:
+            futures = {executor.submit(self.process_item, item): item for item in pending}
+            for done_count, future in enumerate(as_completed(futures), 1):
+                try:
+                    record = future.result()
+                except RequestCancelledError:
+                    continue
+                mark = "✅" if record["status"] == "ok" else "❌"
+                print(
+                    f"{mark} [{done_count}/{len(pending)}] {record['id']}"
+                    + (f": {record['error']}" if record["status"] == "error" else "")
+                )
+        except KeyboardInterrupt:
+            print("🛑 中断しました。再実行すると未完了の項目から再開します。")
+            self.cancel_token.cancel("interrupted")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
+        return self.report(time.perf_counter() - start)
+
+    def report(self, elapsed: float) -> dict:
+        """処理結果とスループットを表示"""
+        processed = self.stats["ok"] + self.stats["error"]
+        throughput = processed / elapsed * 60 if elapsed > 0 else 0.0
+        print("📊 バッチ処理結果:")
+        print(f"   成功: {self.stats['ok']}件 / 失敗: {self.stats['error']}件")
+        print(f"   経過時間: {elapsed:.1f}秒 / スループット: {throughput:.2f}件/分")
+        if processed:
+            print(
+                f"   平均所要時間: ChatGPT {self.stats['chatgpt_seconds'] / processed:.2f}秒"
+                f" / NovelAI {self.stats['novelai_seconds'] / processed:.2f}秒"
+            )
+        return {**self.stats, "elapsed_seconds": elapsed, "items_per_minute": throughput}
+
+
+def main():
+    """バッチCLIのエントリーポイント"""
+    from dotenv import load_dotenv
+
+    # 引数の既定値に.envの設定を使うため、パーサーを作る前に読み込む
+    load_dotenv()
+
+    parser = argparse.ArgumentParser(description="JSONLファイルからイラストを一括生成")
+    parser.add_argument("input", help="入力JSONLファイル")
+    parser.add_argument(
+        "--output-dir", default="batch_outputs", help="画像とmanifest.jsonlの出力先"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=2, help="同時に処理する項目数"
+    )
+    parser.add_argument(
+        "--novelai-concurrency",
+        type=int,
+        default=int(os.getenv("NOVELAI_MAX_CONCURRENCY", 1)),
+        help="NovelAIへの同時生成リクエスト数（アカウントの上限に合わせる）",
+    )
+    args = parser.parse_args()
+
+    from chatGPT import ChatGPTProcessor
+    from novelai import NovelAIGenerator
+
+    items = load_items(args.input)
+
+    # ChatGPTは自然文の入力がある場合のみ初期化する
+    chatgpt = None
+    if any("prompt_data" not in item for item in items):
+        chatgpt = ChatGPTProcessor()
+
+    runner = BatchRunner(
+        args.output_dir,
+        concurrency=args.concurrency,
+        novelai_concurrency=args.novelai_concurrency,
+        chatgpt=chatgpt,
+        novelai=NovelAIGenerator(),
+    )
+    runner.run(items)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+起動時間ベンチマーク
+
+各計測は新しいPythonプロセスで行い、以下を測定する:
+  - import main にかかる時間（遅延インポートの効果）
+  - IllustrationChatService の readiness が立つまでの時間
+  - gradio を含めたWebUI構築までの時間
+
+使い方:
+    python benchmarks/bench_startup.py [--runs 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子プロセスで実行する計測コード（結果はJSONで標準出力の最終行に出す）
+CHILD_SCRIPTS = {
+    "import main": """
+import time
+t0 = time.perf_counter()
+import main
+print(json.dumps({"seconds": time.perf_counter() - t0}))
+""",
+    "service ready": """
+import time
+t0 = time.perf_counter()
+import main
+service = main.IllustrationChatService()
+if not service.wait_until_ready():
+    # 初期化に失敗・タイムアウトした場合は準備完了までの時間として扱わない
+    sys.exit(f"バックエンドの準備に失敗しました: {service.startup_error or 'タイムアウト'}")
+print(json.dumps({"seconds": time.perf_counter() - t0}))
+""",
+    "webui built": """
+import time
+t0 = time.perf_counter()
+import main
+main.create_gradio_interface()
+print(json.dumps({"seconds": time.perf_counter() - t0}))
+""",
+}
+
+
+def run_child(script: str) -> float:
+    """子プロセスで計測コードを実行し、所要秒数を返す"""
+    result = subprocess.run(
+        [sys.executable, "-c", "import json\nimport sys\n" + script],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    return json.loads(result.stdout.strip().splitlines()[-1])["seconds"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間ベンチマーク")
+    parser.add_argument("--runs", type=int, default=5, help="各計測の試行回数")
+    args = parser.parse_args()
+
+    print(f"起動時間ベンチマーク ({args.runs}回試行)")
+    for name, script in CHILD_SCRIPTS.items():
+        try:
+            samples = [run_child(script) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(f"  {name}: 計測失敗 ({e})")
+            continue
+        print(
+            f"  {name}: 中央値 {statistics.median(samples) * 1000:.1f}ms"
+            f" / 最小 {min(samples) * 1000:.1f}ms / 最大 {max(samples) * 1000:.1f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""
+リクエストの協調的キャンセルを扱うモジュール
+（ChatGPT・NovelAIの処理中リクエストを途中で打ち切る）
+"""
+
+import asyncio
+import threading
+import uuid
+from typing import Callable, Optional
+
+
+class RequestCancelledError(Exception):
+    """リクエストがキャンセルされたことを示す例外"""
+
+    def __init__(self, stage: str, reason: str = ""):
+        self.stage = stage
+        self.reason = reason
+        super().__init__(f"リクエストがキャンセルされました (段階: {stage}, 理由: {reason})")
+
+
+class CancellationToken:
+    """
+    1リクエスト分のキャンセル状態を保持するトークン
+
+    別スレッド（Gradioのイベントハンドラー）からcancel()を呼ぶと、
+    登録済みのコールバック経由で実行中のHTTP呼び出しも中断される。
+    """
+
+    def __init__(self):
+        # リクエストの識別子（チャットの状態表示メッセージとの対応付けに使用）
+        self.request_id = uuid.uuid4().hex[:12]
+        self.stage = "queued"
+        self.reason = ""
+        self.finished = False
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def enter_stage(self, stage: str):
+        """処理段階を更新（キャンセル済みなら例外を送出）"""
+        self.raise_if_cancelled()
+        self.stage = stage
+
+    def finish(self):
+        """処理完了を記録（以後のcancel()は無視される）"""
+        with self._lock:
+            self.finished = True
+            self.stage = "done"
+
+    def cancel(self, reason: str = "") -> bool:
+        """
+        キャンセルを要求
+
+        Returns:
+            bool: 今回の呼び出しでキャンセル状態になった場合True
+        """
+        with self._lock:
+            if self.finished or self._event.is_set():
+                return False
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"キャンセルコールバックエラー: {e}")
+        return True
+
+    def raise_if_cancelled(self, stage: Optional[str] = None):
+        """キャンセル済みならRequestCancelledErrorを送出"""
+        if self._event.is_set():
+            raise RequestCancelledError(stage or self.stage, self.reason)
+
+    def wait(self, timeout: float) -> bool:
+        """最大timeout秒待機し、キャンセルされていればTrueを返す"""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback: Callable[[], None]):
+        """キャンセル時に呼ばれるコールバックを登録（登録時点でキャンセル済みなら即実行）"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+class CancellationStats:
+    """キャンセル件数を到達段階・理由ごとに集計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total = 0
+        self.by_stage = {}
+        self.by_reason = {}
+
+    def record(self, stage: str, reason: str):
+        with self._lock:
+            self.total += 1
+            self.by_stage[stage] = self.by_stage.get(stage, 0) + 1
+            self.by_reason[reason] = self.by_reason.get(reason, 0) + 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "total": self.total,
+                "by_stage": dict(self.by_stage),
+                "by_reason": dict(self.by_reason),
+            }
+
+
+async def run_cancellable(coro, token: Optional[CancellationToken], stage: str):
+    """
+    コルーチンをキャンセル可能なタスクとして実行
+
+    トークンがキャンセルされるとタスクをcancel()し、実行中のaiohttp/httpx
+    リクエストを中断した上でRequestCancelledErrorを送出する。
+    """
+    if token is None:
+        return await coro
+
+    if token.cancelled:
+        coro.close()
+        token.raise_if_cancelled(stage)
+
+    loop = asyncio.get_running_loop()
+    task = loop.create_task(coro)
+
+    def on_cancel():
+        loop.call_soon_threadsafe(task.cancel)
+
+    token.add_callback(on_cancel)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if token.cancelled:
+            raise RequestCancelledError(stage, token.reason) from None
+        raise
+    finally:
+        token.remove_callback(on_cancel)
@@ -4,37 +4,17 @@ ChatGPTを使用してユーザーの入力をNovelAI v4.5用の構造化プロ
 
 import os
 import json
-from langchain_openai import ChatOpenAI
-from langchain_core.messages import HumanMessage, SystemMessage
-from dotenv import load_dotenv
+import asyncio
+import threading
+import time
+from typing import Callable, Optional
 
-# 環境変数を読み込み
-load_dotenv()
+from cancellation import CancellationToken, RequestCancelledError, run_cancellable
+from routing import FAST, FULL, ModelRouter, validate_prompt_data, validate_variations
 
-class ChatGPTProcessor:
-    def __init__(self):
-        """ChatGPTプロセッサーを初期化"""
-        self.api_key = os.getenv("OPENAI_API_KEY")
-        if not self.api_key:
-            raise ValueError("OPENAI_API_KEY環境変数が設定されていません")
-        
-        self.llm = ChatOpenAI(
-            api_key=self.api_key,
-            model="gpt-5",
-            temperature=0.7
-        )
-    
-    def enhance_illustration_prompt(self, user_input: str) -> dict:
-        """
-        ユーザーの入力をNovelAI v4.5用の構造化プロンプトに変換
-        
-        Args:
-            user_input (str): ユーザーからの入力テキスト
-            
-        Returns:
-            dict: 構造化されたプロンプト情報
-        """
-        system_prompt = """
+# langchain系は初回利用時に読み込む（起動時間短縮のため）
+
+ILLUSTRATION_SYSTEM_PROMPT = """
 あなたはNovelAI v4.5画像生成のプロンプトエンジニアです。
 ユーザーの要求を以下のJSON形式で出力してください：
 
@@ -71,6 +51,162 @@ class ChatGPTProcessor:
   ]
 }
 """
+
+# バリエーション生成時にシステムプロンプトへ追加する指示
+VARIATIONS_INSTRUCTION = """
+バリエーションモード：
+ユーザーの要求を満たす案を{count}通り作成し、以下のJSON形式で出力してください：
+{{"variations": [上記形式のJSON, ...]}}
+- 各案は背景・ポーズ・構図・カメラアングルなどを互いに大きく変えること
+- キャラクターの人数と外見の特徴（髪色・目の色・服装など、ユーザーが指定したもの）は全案で維持すること
+"""
+
+class ChatGPTProcessor:
+    def __init__(self):
+        """ChatGPTプロセッサーを初期化"""
+        self.api_key = os.getenv("OPENAI_API_KEY")
+        if not self.api_key:
+            raise ValueError("OPENAI_API_KEY環境変数が設定されていません")
+
+        from langchain_openai import ChatOpenAI
+
+        self.llm = ChatOpenAI(
+            api_key=self.api_key,
+            model=os.getenv("OPENAI_MODEL", "gpt-5"),
+            temperature=0.7
+        )
+
+        # 単純な入力は高速モデルで処理（OPENAI_FAST_MODELが空ならルーティングしない）
+        fast_model = os.getenv("OPENAI_FAST_MODEL", "gpt-5-mini")
+        self.fast_llm = None
+        if fast_model:
+            self.fast_llm = ChatOpenAI(
+                api_key=self.api_key,
+                model=fast_model,
+                temperature=0.7
+            )
+        self.router = ModelRouter(fast_available=self.fast_llm is not None)
+
+        # 非同期クライアントの接続プールを使い回すため、専用のイベントループで実行
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _run_async(self, coro):
+        """専用イベントループ上でコルーチンを実行し、結果を待つ"""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="chatgpt-loop", daemon=True
+                ).start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def _invoke(self, llm, messages, cancel_token: Optional[CancellationToken]):
+        if cancel_token is None:
+            return llm.invoke(messages)
+        # キャンセル可能な非同期呼び出しで実行（キャンセル時はHTTP接続ごと中断）
+        return self._run_async(
+            run_cancellable(llm.ainvoke(messages), cancel_token, "chatgpt")
+        )
+
+    @staticmethod
+    def _parse(response, validate: Callable[[object], bool]):
+        """返答をJSONとして解析し、検証に通れば返す（通らなければNone）"""
+        try:
+            parsed = json.loads(response.content)
+        except json.JSONDecodeError as e:
+            print(f"JSON解析エラー: {e}")
+            return None
+        return parsed if validate(parsed) else None
+
+    def _invoke_routed(
+        self,
+        messages,
+        tier: str,
+        validate: Callable[[object], bool],
+        cancel_token: Optional[CancellationToken],
+    ):
+        """
+        指定された階層のモデルで呼び出し、JSONとして解析・検証
+
+        高速モデルの呼び出しが失敗するか、出力が検証に通らない場合は通常モデルで再実行する。
+        失敗した呼び出しも階層ごとのレイテンシに記録する。
+
+        Returns:
+            tuple: (LLMの返答, 検証済みのJSON（解析・検証に失敗した場合はNone）)
+        """
+        if tier == FAST and self.fast_llm is not None:
+            start = time.perf_counter()
+            try:
+                response = self._invoke(self.fast_llm, messages, cancel_token)
+            except RequestCancelledError:
+                raise
+            except Exception as e:
+                response = None
+                print(f"高速モデルエラー: {e}")
+            self.router.record_latency(FAST, time.perf_counter() - start)
+
+            if response is not None:
+                print(f"ChatGPT返答（高速モデル）:\n{response.content}")
+                parsed = self._parse(response, validate)
+                if parsed is not None:
+                    return response, parsed
+                print("高速モデルの出力が検証に失敗しました")
+            print("⤴️ 通常モデルで再実行します")
+            self.router.record_escalation()
+
+        start = time.perf_counter()
+        try:
+            response = self._invoke(self.llm, messages, cancel_token)
+        except RequestCancelledError:
+            raise
+        except Exception:
+            self.router.record_latency(FULL, time.perf_counter() - start)
+            raise
+        self.router.record_latency(FULL, time.perf_counter() - start)
+        print(f"ChatGPT返答:\n{response.content}")
+        parsed = self._parse(response, validate)
+        if parsed is None:
+            print("通常モデルの出力が検証に失敗しました")
+        return response, parsed
+
+    def warm_up(self) -> bool:
+        """OpenAI APIへの接続を事前に確立（TLSハンドシェイク等を初回リクエストから除外）"""
+        client = self.llm.root_async_client
+
+        async def _ping():
+            # models.list()はコルーチンではなくawait可能なページネーターを返すため、
+            # コルーチンで包んでから専用イベントループに渡す
+            await client.models.list()
+
+        try:
+            self._run_async(_ping())
+            print("✓ OpenAI API接続ウォームアップ完了")
+            return True
+        except Exception as e:
+            print(f"OpenAI API接続ウォームアップエラー: {e}")
+            return False
+    
+    def enhance_illustration_prompt(
+        self,
+        user_input: str,
+        cancel_token: Optional[CancellationToken] = None,
+        strict: bool = False,
+    ) -> dict:
+        """
+        ユーザーの入力をNovelAI v4.5用の構造化プロンプトに変換
+        
+        Args:
+            user_input (str): ユーザーからの入力テキスト
+            cancel_token (CancellationToken, optional): キャンセル用トークン
+            strict (bool): Trueの場合、フォールバックを返さずに例外を送出する
+            
+        Returns:
+            dict: 構造化されたプロンプト情報
+
+        Raises:
+            ValueError: strict=Trueで、返答が構造化プロンプトの形式ではない場合
+        """
         
         human_prompt = f"""
 以下のユーザーの要求をJSON形式で構造化してください：
@@ -78,22 +214,29 @@ class ChatGPTProcessor:
 {user_input}
 """
         
+        from langchain_core.messages import HumanMessage, SystemMessage
+
         messages = [
-            SystemMessage(content=system_prompt),
+            SystemMessage(content=ILLUSTRATION_SYSTEM_PROMPT),
             HumanMessage(content=human_prompt)
         ]
         
         try:
             print("ChatGPT API呼び出し中...")
-            response = self.llm.invoke(messages)
-            print(f"ChatGPT返答:\n{response.content}")
-            
-            # JSONパース
-            try:
-                parsed_response = json.loads(response.content)
+            response, parsed_response = self._invoke_routed(
+                messages,
+                self.router.route(user_input),
+                validate_prompt_data,
+                cancel_token,
+            )
+
+            if strict and not validate_prompt_data(parsed_response):
+                raise ValueError(
+                    f"構造化プロンプトの形式ではない返答です: {response.content[:200]}"
+                )
+            if parsed_response is not None:
                 return parsed_response
-            except json.JSONDecodeError as e:
-                print(f"JSON解析エラー: {e}")
+            else:
                 # フォールバック：シンプルな構造を返す
                 return {
                     "characterCount": 1,
@@ -106,8 +249,13 @@ class ChatGPTProcessor:
                     ]
                 }
                 
+        except RequestCancelledError:
+            print("ChatGPT API呼び出しをキャンセルしました")
+            raise
         except Exception as e:
             print(f"ChatGPT APIエラー: {e}")
+            if strict:
+                raise
             return {
                 "characterCount": 1,
                 "prompt": "masterpiece, best_quality",
@@ -119,6 +267,119 @@ class ChatGPTProcessor:
                 ]
             }
 
+    def enhance_illustration_variations(
+        self,
+        user_input: str,
+        count: int,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> list:
+        """
+        ユーザーの入力から、構図の異なる複数の構造化プロンプトを1回の呼び出しで作成
+
+        Args:
+            user_input (str): ユーザーからの入力テキスト
+            count (int): 作成する案の数
+            cancel_token (CancellationToken, optional): キャンセル用トークン
+
+        Returns:
+            list: 構造化されたプロンプト情報のリスト（最大count件）
+        """
+        human_prompt = f"""
+以下のユーザーの要求を{count}通りのJSONに構造化してください：
+
+{user_input}
+"""
+
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [
+            SystemMessage(
+                content=ILLUSTRATION_SYSTEM_PROMPT + VARIATIONS_INSTRUCTION.format(count=count)
+            ),
+            HumanMessage(content=human_prompt)
+        ]
+
+        try:
+            print(f"ChatGPT API呼び出し中（バリエーション{count}件）...")
+            _, parsed_response = self._invoke_routed(
+                messages,
+                self.router.route(user_input),
+                validate_variations,
+                cancel_token,
+            )
+            if validate_variations(parsed_response):
+                return parsed_response["variations"][:count]
+            print("バリエーション形式ではない返答のため、通常の変換で1件だけ作成します")
+
+        except RequestCancelledError:
+            print("ChatGPT API呼び出しをキャンセルしました")
+            raise
+        except Exception as e:
+            print(f"バリエーション生成エラー: {e}")
+
+        return [self.enhance_illustration_prompt(user_input, cancel_token=cancel_token)]
+
+    def refine_prompt(
+        self,
+        prompt_data: dict,
+        instruction: str,
+        cancel_token: Optional[CancellationToken] = None,
+    ) -> Optional[list]:
+        """
+        前回の構造化プロンプトへの修正内容をJSON Patch形式で取得
+
+        Args:
+            prompt_data (dict): 前回の構造化プロンプト
+            instruction (str): ユーザーの修正要望
+            cancel_token (CancellationToken, optional): キャンセル用トークン
+
+        Returns:
+            list: JSON Patchの操作リスト（取得できなかった場合はNone）
+        """
+        system_prompt = """
+NovelAI v4.5用の構造化プロンプト（JSON）を、ユーザーの修正要望に合わせて編集します。
+変更点だけをRFC 6902 JSON Patch形式の配列で出力してください。
+- 操作はadd / remove / replaceのみ
+- パスの例: /prompt, /characterPrompts/0/prompt, /characterPrompts/0/position, /characterPrompts/-
+- タグはDanbooruタグ形式（英語、アンダースコア区切り）、positionはA1-E5
+- 要望に関係しないタグ・構図は変更しない
+- 必ずJSON配列のみを出力（マークダウン不要）
+"""
+        human_prompt = f"""
+現在のJSON:
+{json.dumps(prompt_data, ensure_ascii=False)}
+
+修正要望:
+{instruction}
+"""
+
+        from langchain_core.messages import HumanMessage, SystemMessage
+
+        messages = [
+            SystemMessage(content=system_prompt),
+            HumanMessage(content=human_prompt)
+        ]
+
+        try:
+            print("ChatGPT API呼び出し中（差分修正）...")
+            # 差分の出力は小さいため高速モデルを優先する（判定件数には実際の階層を含める）
+            tier = FAST if self.router.fast_available else FULL
+            self.router.record_decision(tier)
+            _, patch = self._invoke_routed(
+                messages, tier, lambda parsed: isinstance(parsed, list), cancel_token
+            )
+            if not isinstance(patch, list):
+                print("JSON Patch形式ではない返答のため破棄します")
+                return None
+            return patch
+
+        except RequestCancelledError:
+            print("ChatGPT API呼び出しをキャンセルしました")
+            raise
+        except Exception as e:
+            print(f"差分修正エラー: {e}")
+            return None
+
 def test_chatgpt():
     """テスト用関数"""
     try:
@@ -132,4 +393,7 @@ def test_chatgpt():
         print(f"テストエラー: {e}")
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
     test_chatgpt()
\ No newline at end of file
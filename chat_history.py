@@ -0,0 +1,235 @@
+"""
+チャット履歴の上限管理と、生成結果メッセージのテンプレート
+"""
+
+import os
+import re
+from datetime import datetime
+
+# 古いやり取りをまとめた要約メッセージの識別子（Gradioのmetadata.idに設定）
+SUMMARY_ID = "history-summary"
+
+# 要約メッセージに残す入力の最大件数（要約自体が肥大化しないように）
+SUMMARY_MAX_ENTRIES = 20
+EMPTY_SUMMARY = "・(入力なし)"
+
+# 実行中の状態表示メッセージの識別子（metadata.idに「接頭辞+リクエストID」を設定）
+STATUS_ID_PREFIX = "status-"
+SUPERSEDED_MESSAGE = "🛑 新しいリクエストに置き換えたため中断しました"
+
+# 成功メッセージのテンプレート（モジュール読み込み時に一度だけ定義）
+SUCCESS_TEMPLATE = """
+✅ {header}
+
+**キャラクター数:** {character_count}
+
+**背景・環境:**
+{prompt}
+
+{character_info}
+
+**生成時刻:** {timestamp}
+"""
+HISTORY_DETAIL_TEMPLATE = """
+**キャラクター数:** {character_count}
+
+**背景・環境:**
+{prompt}
+
+{character_info}
+"""
+GENERATED_HEADER = "**イラスト生成完了！**"
+REGENERATED_HEADER = "**再生成完了！** (GPT-5処理をスキップ)\n\n**元の入力:** {user_input}"
+CHARACTER_LINE = "**キャラクター{index}**{position_text}: {prompt}\n"
+
+# バリエーション生成の進捗・完了メッセージ
+VARIATIONS_TEMPLATE = """
+{header} ({completed}/{total}枚)
+
+**元の入力:** {user_input}
+
+{variation_info}
+"""
+VARIATIONS_PROGRESS_HEADER = "🎲 **バリエーションを生成中...**"
+VARIATIONS_DONE_HEADER = "✅ **バリエーション生成完了！** (ギャラリーから選ぶと再生成・修正の対象になります)"
+VARIATION_LINE = "**案{index}**{status}: {prompt}\n"
+
+
+def render_character_info(prompt_data: dict) -> str:
+    """キャラクターごとのプロンプトと位置を1行ずつ整形"""
+    lines = []
+    for i, char in enumerate(prompt_data.get("characterPrompts", [])):
+        position = char.get("position")
+        lines.append(
+            CHARACTER_LINE.format(
+                index=i + 1,
+                position_text=f" (位置: {position})" if position else " (位置指定なし)",
+                prompt=char.get("prompt", ""),
+            )
+        )
+    return "".join(lines)
+
+
+def render_history_detail(prompt_data: dict) -> str:
+    """履歴タブに表示するプロンプト情報"""
+    return HISTORY_DETAIL_TEMPLATE.format(
+        character_count=prompt_data.get("characterCount", 1),
+        prompt=prompt_data.get("prompt", ""),
+        character_info=render_character_info(prompt_data),
+    )
+
+
+def render_success_message(prompt_data: dict, user_input: str = None) -> str:
+    """
+    生成完了メッセージを作成
+
+    Args:
+        prompt_data (dict): 構造化プロンプト情報
+        user_input (str, optional): 指定すると再生成メッセージ（元の入力付き）になる
+
+    Returns:
+        str: Markdown形式のメッセージ
+    """
+    if user_input is None:
+        header = GENERATED_HEADER
+    else:
+        header = REGENERATED_HEADER.format(user_input=user_input)
+
+    return SUCCESS_TEMPLATE.format(
+        header=header,
+        character_count=prompt_data.get("characterCount", 1),
+        prompt=prompt_data.get("prompt", ""),
+        character_info=render_character_info(prompt_data),
+        timestamp=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def render_variations_message(
+    user_input: str, variations: list, completed: set, done: bool = False
+) -> str:
+    """
+    バリエーション生成の進捗メッセージを作成
+
+    Args:
+        user_input (str): ユーザーの入力
+        variations (list): 構造化プロンプト情報のリスト
+        completed (set): 生成が完了した案の番号（0始まり）
+        done (bool): Trueなら完了メッセージにする
+    """
+    lines = []
+    for i, variation in enumerate(variations):
+        lines.append(
+            VARIATION_LINE.format(
+                index=i + 1,
+                status=" ✓" if i in completed else "",
+                prompt=variation.get("prompt", ""),
+            )
+        )
+    return VARIATIONS_TEMPLATE.format(
+        header=VARIATIONS_DONE_HEADER if done else VARIATIONS_PROGRESS_HEADER,
+        completed=len(completed),
+        total=len(variations),
+        user_input=user_input,
+        variation_info="".join(lines),
+    )
+
+
+def status_message(content: str, request_id: str) -> dict:
+    """リクエストの状態表示メッセージ（置き換えられた場合に後から特定できるよう識別子を付ける）"""
+    return {
+        "role": "assistant",
+        "content": content,
+        "metadata": {"id": STATUS_ID_PREFIX + request_id},
+    }
+
+
+def resolve_superseded(chat_history: list, request_id: str) -> int:
+    """
+    置き換えられたリクエストの状態表示を中断メッセージに書き換える
+
+    置き換えられたリクエストは以後チャットに書き込まないため、新しいリクエストが
+    ブラウザから受け取った履歴に残る「補完中...」等の表示をここで確定させる。
+
+    Returns:
+        int: 書き換えたメッセージ数
+    """
+    status_id = STATUS_ID_PREFIX + request_id
+    resolved = 0
+    for message in chat_history:
+        metadata = message.get("metadata") or {}
+        if metadata.get("id") == status_id:
+            message["content"] = SUPERSEDED_MESSAGE
+            resolved += 1
+    return resolved
+
+
+def history_limit() -> int:
+    """保持するメッセージ数の上限（0以下なら無制限）"""
+    return int(os.getenv("CHAT_HISTORY_MAX_MESSAGES", 20))
+
+
+def _is_summary(message: dict) -> bool:
+    metadata = message.get("metadata") or {}
+    return metadata.get("id") == SUMMARY_ID
+
+
+def compact_history(chat_history: list, max_messages: int = None, reserve: int = 0) -> list:
+    """
+    チャット履歴を上限件数に収める（古いメッセージは1件の要約にまとめる）
+
+    リクエストの開始時に一度だけ呼び、以降のyieldでは最後のメッセージだけが
+    変化するようにする。履歴はその場で書き換える。
+    ユーザーの入力とそれに対する返答を分けないよう、残す範囲はユーザーの
+    メッセージから始める。
+
+    Args:
+        chat_history (list): messages形式のチャット履歴
+        max_messages (int, optional): 要約を除いて保持するメッセージ数
+        reserve (int): この後に追加するメッセージ数（追加後に上限に収まるよう空けておく）
+
+    Returns:
+        list: 書き換え後のチャット履歴（引数と同じリスト）
+    """
+    if max_messages is None:
+        max_messages = history_limit()
+    if max_messages <= 0:
+        return chat_history
+
+    summary = chat_history[0] if chat_history and _is_summary(chat_history[0]) else None
+    messages = chat_history[1:] if summary else chat_history[:]
+    budget = max(max_messages - reserve, 0)
+    if len(messages) <= budget:
+        return chat_history
+
+    # 上限に収まる範囲で最も古いユーザーのメッセージから残す
+    start = len(messages) - budget
+    while start < len(messages) and messages[start].get("role") != "user":
+        start += 1
+    overflow = messages[:start]
+    kept = messages[start:]
+
+    # 要約には古いユーザー入力だけを残す（生成結果の詳細は省く）
+    entries = summary["content"].splitlines() if summary else []
+    entries = [entry for entry in entries if entry != EMPTY_SUMMARY]
+    for message in overflow:
+        if message.get("role") == "user":
+            text = str(message.get("content", "")).replace("\n", " ")
+            entries.append(f"・{text[:40]}{'…' if len(text) > 40 else ''}")
+    # Gradio経由で戻ってくるmetadataは既定のキーのみのため、件数はlogから読み取る
+    previous = re.sub(r"\D", "", summary["metadata"].get("log") or "") if summary else ""
+    collapsed = int(previous or 0) + len(overflow)
+    entries = entries[-SUMMARY_MAX_ENTRIES:]
+
+    chat_history[:] = [
+        {
+            "role": "assistant",
+            "content": "\n".join(entries) or EMPTY_SUMMARY,
+            "metadata": {
+                "id": SUMMARY_ID,
+                "title": "🗂️ 以前のやり取り",
+                "log": f"{collapsed}件を省略",
+            },
+        },
+        *kept,
+    ]
+    return chat_history
@@ -0,0 +1,372 @@
+"""
+生成履歴のインデックス（SQLite）
+
+outputsディレクトリの画像を1件ずつ走査しなくても履歴を表示・検索できるように、
+保存時に画像パス・サムネイルパス・入力文・構造化プロンプトを登録する。
+タグはタグ→画像の索引テーブルで検索する。入力文の検索語は、3文字以上ならFTS5（trigram）、
+「猫」「金髪」のような1〜2文字なら入力文の1文字・2文字の部分文字列の索引テーブルで引く。
+一覧は (created_at, id) のキーセットでページングし、深いページでも読み飛ばしが発生しない。
+
+使い方:
+    python history_index.py --rebuild   # 既存のoutputsを取り込み、サムネイルを作成
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import time
+from contextlib import closing
+from typing import Optional
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    thumbnail_path TEXT,
+    user_input TEXT NOT NULL DEFAULT '',
+    prompt_data TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_images_created ON images (created_at, id);
+CREATE TABLE IF NOT EXISTS image_tags (
+    tag TEXT NOT NULL,
+    image_id INTEGER NOT NULL,
+    PRIMARY KEY (tag, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_image_tags_image ON image_tags (image_id);
+CREATE TABLE IF NOT EXISTS images_ngrams (
+    gram TEXT NOT NULL,
+    image_id INTEGER NOT NULL,
+    PRIMARY KEY (gram, image_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_images_ngrams_image ON images_ngrams (image_id);
+"""
+
+# 入力文の全文検索（日本語も部分一致で引けるようにtrigramで分割）
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS images_fts USING fts5(user_input, tokenize='trigram');
+"""
+
+# trigramで索引を引ける最小の文字数（これより短い語はimages_ngramsで検索）
+FTS_MIN_LENGTH = 3
+
+IMAGE_EXTENSIONS = (".png", ".webp", ".jpeg", ".jpg")
+
+
+def extract_tags(prompt_data: Optional[dict]) -> list:
+    """構造化プロンプトからDanbooruタグを抽出（小文字・アンダースコア区切りに正規化）"""
+    if not prompt_data:
+        return []
+    prompts = [prompt_data.get("prompt", "")]
+    prompts += [char.get("prompt", "") for char in prompt_data.get("characterPrompts", [])]
+    tags = set()
+    for prompt in prompts:
+        for tag in str(prompt).split(","):
+            tag = normalize_tag(tag)
+            if tag:
+                tags.add(tag)
+    return sorted(tags)
+
+
+def normalize_tag(tag: str) -> str:
+    # 強調記号（{} []）を外し、空白はアンダースコアに揃える
+    tag = re.sub(r"[{}\[\]]", "", tag).strip().lower()
+    return re.sub(r"\s+", "_", tag)
+
+
+def text_ngrams(text: str) -> set:
+    """入力文の1文字・2文字の部分文字列（空白をまたぐものは含めない）"""
+    grams = set()
+    for word in text.lower().split():
+        grams.update(word)
+        grams.update(word[i : i + 2] for i in range(len(word) - 1))
+    return grams
+
+
+def parse_query(query: str) -> tuple:
+    """
+    検索語をタグと入力文に分ける（英数字・記号だけの語はタグ、それ以外は入力文）
+
+    Returns:
+        tuple: (タグのリスト, 入力文の検索文字列)
+    """
+    tags = []
+    words = []
+    for word in re.split(r"[\s,、]+", query.strip()):
+        if not word:
+            continue
+        if word.isascii():
+            tags.append(word)
+        else:
+            words.append(word)
+    return tags, " ".join(words)
+
+
+class HistoryIndex:
+    """生成画像の索引（UIプロセスとワーカープロセスで共有可能）"""
+
+    def __init__(self, path: str = None):
+        self.path = path or os.getenv("HISTORY_INDEX_PATH", "outputs/history.sqlite3")
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            has_ngrams = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'images_ngrams'"
+            ).fetchone()
+            conn.executescript(_SCHEMA)
+            if not has_ngrams:
+                self._backfill_ngrams(conn)
+            try:
+                conn.executescript(_FTS_SCHEMA)
+                self.fts_enabled = True
+            except sqlite3.OperationalError as e:
+                # FTS5・trigramに未対応のSQLiteではLIKE検索のみ
+                print(f"⚠️ 全文検索を利用できません（LIKE検索を使用）: {e}")
+                self.fts_enabled = False
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _backfill_ngrams(conn: sqlite3.Connection):
+        """索引テーブルがなかった既存の履歴に1文字・2文字の索引を作成"""
+        rows = conn.execute("SELECT id, user_input FROM images").fetchall()
+        if not rows:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        for row in rows:
+            conn.executemany(
+                "INSERT OR IGNORE INTO images_ngrams (gram, image_id) VALUES (?, ?)",
+                [(gram, row["id"]) for gram in text_ngrams(row["user_input"])],
+            )
+        conn.execute("COMMIT")
+        print(f"🔧 既存の履歴{len(rows)}件に1文字・2文字の検索索引を作成しました")
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        entry = dict(row)
+        entry["prompt_data"] = json.loads(entry["prompt_data"]) if entry["prompt_data"] else None
+        return entry
+
+    def add(
+        self,
+        path: str,
+        thumbnail_path: str = None,
+        user_input: str = "",
+        prompt_data: dict = None,
+        created_at: float = None,
+    ) -> int:
+        """画像を登録（同じパスが登録済みなら上書き）してIDを返す"""
+        created_at = created_at or time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id FROM images WHERE path = ?", (path,)).fetchone()
+            if row is not None:
+                self._delete(conn, row["id"])
+            image_id = conn.execute(
+                "INSERT INTO images (path, thumbnail_path, user_input, prompt_data, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    path,
+                    thumbnail_path,
+                    user_input or "",
+                    json.dumps(prompt_data, ensure_ascii=False) if prompt_data else None,
+                    created_at,
+                ),
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO image_tags (tag, image_id) VALUES (?, ?)",
+                [(tag, image_id) for tag in extract_tags(prompt_data)],
+            )
+            conn.executemany(
+                "INSERT INTO images_ngrams (gram, image_id) VALUES (?, ?)",
+                [(gram, image_id) for gram in text_ngrams(user_input or "")],
+            )
+            if self.fts_enabled:
+                conn.execute(
+                    "INSERT INTO images_fts (rowid, user_input) VALUES (?, ?)",
+                    (image_id, user_input or ""),
+                )
+            conn.execute("COMMIT")
+            return image_id
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _delete(self, conn: sqlite3.Connection, image_id: int):
+        conn.execute("DELETE FROM image_tags WHERE image_id = ?", (image_id,))
+        conn.execute("DELETE FROM images_ngrams WHERE image_id = ?", (image_id,))
+        if self.fts_enabled:
+            conn.execute("DELETE FROM images_fts WHERE rowid = ?", (image_id,))
+        conn.execute("DELETE FROM images WHERE id = ?", (image_id,))
+
+    def get(self, image_id: int) -> Optional[dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM images WHERE id = ?", (image_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def _conditions(self, tags: list, text: str) -> tuple:
+        """検索条件のWHERE句の条件とパラメーター"""
+        conditions = []
+        params = []
+        for tag in tags or []:
+            conditions.append("id IN (SELECT image_id FROM image_tags WHERE tag = ?)")
+            params.append(normalize_tag(tag))
+
+        # 空白で区切られた語は全てを含むものに絞り込む
+        ngram_condition = "id IN (SELECT image_id FROM images_ngrams WHERE gram = ?)"
+        for word in text.lower().split():
+            if len(word) < FTS_MIN_LENGTH:
+                conditions.append(ngram_condition)
+                params.append(word)
+            elif self.fts_enabled:
+                conditions.append("id IN (SELECT rowid FROM images_fts WHERE images_fts MATCH ?)")
+                params.append('"' + word.replace('"', '""') + '"')
+            else:
+                # 2文字ずつの索引で候補を絞り、並びはLIKEで確認する
+                for i in range(len(word) - 1):
+                    conditions.append(ngram_condition)
+                    params.append(word[i : i + 2])
+                escaped = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                conditions.append("user_input LIKE ? ESCAPE '\\'")
+                params.append(f"%{escaped}%")
+        return conditions, params
+
+    def search(
+        self, tags: list = None, text: str = "", cursor: tuple = None, page_size: int = 24
+    ) -> tuple:
+        """
+        タグ（AND）・入力文の部分一致で検索し、新しい順に1ページ分を返す
+
+        Args:
+            tags (list, optional): 全てを含む画像に絞り込むタグ
+            text (str): 入力文に含まれる文字列（空白区切りで複数指定するとAND）
+            cursor (tuple, optional): 前のページが返したnext_cursor（Noneなら先頭ページ）
+            page_size (int): 1ページの件数
+
+        Returns:
+            tuple: (画像のリスト, 次のページのカーソル（最後のページならNone）)
+        """
+        conditions, params = self._conditions(tags, text)
+        if cursor is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT * FROM images {where} ORDER BY created_at DESC, id DESC LIMIT ?",
+                params + [page_size + 1],
+            ).fetchall()
+
+        entries = [self._to_dict(row) for row in rows[:page_size]]
+        next_cursor = None
+        if len(rows) > page_size:
+            next_cursor = (entries[-1]["created_at"], entries[-1]["id"])
+        return entries, next_cursor
+
+    def count(self, tags: list = None, text: str = "") -> int:
+        """検索条件に該当する件数"""
+        conditions, params = self._conditions(tags, text)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with closing(self._connect()) as conn:
+            return conn.execute(f"SELECT COUNT(*) FROM images {where}", params).fetchone()[0]
+
+    def prune_missing(self) -> int:
+        """ファイルが削除された画像を索引から除く"""
+        with closing(self._connect()) as conn:
+            rows = conn.execute("SELECT id, path FROM images").fetchall()
+            missing = [row["id"] for row in rows if not os.path.exists(row["path"])]
+            conn.execute("BEGIN IMMEDIATE")
+            for image_id in missing:
+                self._delete(conn, image_id)
+            conn.execute("COMMIT")
+        return len(missing)
+
+    def indexed_paths(self) -> set:
+        with closing(self._connect()) as conn:
+            return {row["path"] for row in conn.execute("SELECT path FROM images")}
+
+
+def rebuild(index: HistoryIndex, outputs_dir: str = "outputs") -> int:
+    """
+    索引にない画像を取り込み、サムネイルを作成
+
+    画像に埋め込まれた構造化プロンプト（embed_metadata）があればタグも登録する。
+
+    Returns:
+        int: 取り込んだ画像の数
+    """
+    from postprocess import ImagePostProcessor, load_config
+
+    removed = index.prune_missing()
+    if removed:
+        print(f"🗑️ 削除済みの画像 {removed}件を索引から除きました")
+
+    indexed = index.indexed_paths()
+    paths = sorted(
+        path
+        for path in (
+            os.path.abspath(os.path.join(outputs_dir, name))
+            for name in os.listdir(outputs_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if path not in indexed
+    )
+    if not paths:
+        print("✓ 索引は最新です")
+        return 0
+
+    # サムネイルの作成だけを行う（画像本体は書き換えない）
+    config = dict(load_config(), steps=["thumbnail"], output_format="png")
+    processor = ImagePostProcessor(config)
+    futures = [(path, processor.submit(path)) for path in paths]
+
+    added = 0
+    for path, future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            print(f"❌ 取り込みに失敗しました: {path}: {e}")
+            continue
+        prompt_data = result.get("metadata")
+        index.add(
+            path,
+            thumbnail_path=result.get("thumbnail_path"),
+            prompt_data=prompt_data,
+            created_at=os.path.getmtime(path),
+        )
+        added += 1
+    processor.shutdown()
+    print(f"✅ {added}件を索引に取り込みました")
+    return added
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成履歴の索引")
+    parser.add_argument(
+        "--rebuild", action="store_true", help="既存の画像を取り込み、サムネイルを作成"
+    )
+    parser.add_argument("--outputs-dir", default="outputs", help="画像のディレクトリ")
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    index = HistoryIndex()
+    if args.rebuild:
+        rebuild(index, args.outputs_dir)
+    print(f"📚 登録件数: {index.count()}件 ({index.path})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+SQLiteを使ったローカルジョブキュー
+（UIプロセスがジョブを投入し、ワーカープロセスが生成処理を行う）
+
+ワーカーはジョブをリース付きで取得し、処理中は定期的にリースを延長する。
+ワーカーがクラッシュしてリースが切れたジョブは、別のワーカーが再取得する。
+"""
+
+import json
+import os
+import sqlite3
+import time
+import uuid
+from contextlib import closing
+from typing import Optional
+
+# ジョブの状態
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    stage TEXT NOT NULL DEFAULT '',
+    status_message TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker_id TEXT,
+    lease_expires_at REAL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, created_at);
+"""
+
+
+class SQLiteJobQueue:
+    """SQLiteファイルをバックエンドとするジョブキュー（複数プロセスから共有可能）"""
+
+    def __init__(self, path: str = None, max_attempts: int = None):
+        self.path = path or os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")
+        self.max_attempts = max_attempts or int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # 呼び出しごとに接続し、スレッド・プロセス間で接続を共有しない
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _to_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, payload: dict) -> str:
+        """ジョブを投入してジョブIDを返す"""
+        job_id = uuid.uuid4().hex
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, payload, state, created_at) VALUES (?, ?, ?, ?)",
+                (job_id, json.dumps(payload, ensure_ascii=False), QUEUED, time.time()),
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row) if row else None
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[dict]:
+        """
+        待機中のジョブ、またはリース切れのジョブを1件取得
+
+        Returns:
+            dict: 取得したジョブ（対象がなければNone）
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            # 書き込みロックを先に取り、複数ワーカーが同じジョブを取らないようにする
+            conn.execute("BEGIN IMMEDIATE")
+
+            # リトライ上限に達したリース切れジョブは失敗扱いにする
+            conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ? "
+                "WHERE state = ? AND lease_expires_at < ? AND attempts >= ?",
+                (FAILED, "ワーカーのリースが切れました", now, RUNNING, now, self.max_attempts),
+            )
+
+            row = conn.execute(
+                "SELECT id FROM jobs "
+                "WHERE state = ? OR (state = ? AND lease_expires_at < ?) "
+                "ORDER BY created_at LIMIT 1",
+                (QUEUED, RUNNING, now),
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+
+            conn.execute(
+                "UPDATE jobs SET state = ?, worker_id = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, started_at = ? WHERE id = ?",
+                (RUNNING, worker_id, now + lease_seconds, now, row["id"]),
+            )
+            job = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+            conn.execute("COMMIT")
+            return self._to_dict(job)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def heartbeat(
+        self,
+        job_id: str,
+        worker_id: str,
+        lease_seconds: float,
+        stage: str = None,
+        status_message: str = None,
+    ) -> bool:
+        """
+        リースを延長（stage・status_messageを指定すると進捗も更新）
+
+        Returns:
+            bool: リースを保持している場合True（キャンセル・リース喪失時はFalse）
+        """
+        assignments = ["lease_expires_at = ?"]
+        params = [time.time() + lease_seconds]
+        if stage is not None:
+            assignments.append("stage = ?")
+            params.append(stage)
+        if status_message is not None:
+            assignments.append("status_message = ?")
+            params.append(status_message)
+
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {', '.join(assignments)} "
+                "WHERE id = ? AND worker_id = ? AND state = ?",
+                (*params, job_id, worker_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker_id: str, result: dict) -> bool:
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, result = ?, finished_at = ? "
+                "WHERE id = ? AND worker_id = ? AND state = ?",
+                (DONE, json.dumps(result, ensure_ascii=False), time.time(), job_id, worker_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, worker_id: str, error: str) -> bool:
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, error = ?, finished_at = ? "
+                "WHERE id = ? AND worker_id = ? AND state = ?",
+                (FAILED, error, time.time(), job_id, worker_id, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def cancel(self, job_id: str) -> bool:
+        """未完了のジョブをキャンセル（処理中のワーカーは次のハートビートで検知する）"""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET state = ?, finished_at = ? WHERE id = ? AND state IN (?, ?)",
+                (CANCELLED, time.time(), job_id, QUEUED, RUNNING),
+            )
+        return cursor.rowcount == 1
+
+    def metrics(self) -> dict:
+        """キューの深さ・状態別件数・最古の待機ジョブの待ち時間"""
+        now = time.time()
+        with closing(self._connect()) as conn:
+            counts = {
+                row["state"]: row["count"]
+                for row in conn.execute(
+                    "SELECT state, COUNT(*) AS count FROM jobs GROUP BY state"
+                )
+            }
+            oldest = conn.execute(
+                "SELECT MIN(created_at) AS oldest FROM jobs WHERE state = ?", (QUEUED,)
+            ).fetchone()["oldest"]
+            expired = conn.execute(
+                "SELECT COUNT(*) AS count FROM jobs WHERE state = ? AND lease_expires_at < ?",
+                (RUNNING, now),
+            ).fetchone()["count"]
+
+        return {
+            "queue_depth": counts.get(QUEUED, 0),
+            "running": counts.get(RUNNING, 0),
+            "expired_leases": expired,
+            "oldest_queued_seconds": round(now - oldest, 1) if oldest else 0.0,
+            "by_state": counts,
+        }
+
+    def purge_finished(self, older_than_seconds: float) -> int:
+        """完了から一定時間経過したジョブを削除"""
+        with closing(self._connect()) as conn:
+            cursor = conn.execute(
+                "DELETE FROM jobs WHERE state IN (?, ?, ?) AND finished_at < ?",
+                (*FINISHED_STATES, time.time() - older_than_seconds),
+            )
+        return cursor.rowcount
@@ -3,54 +3,354 @@ Gradio WebUIを使ったイラスト生成チャットサービス
 """
 
 import os
-import gradio as gr
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 
-# 自作モジュールをインポート
+# 自作モジュールをインポート（gradio等の重いライブラリは必要になった時点で読み込む）
+from startup import profiler
 from chatGPT import ChatGPTProcessor
-from novelai import NovelAIGenerator
+from novelai import PRESET_SETTINGS, NovelAIGenerator
+from cancellation import CancellationStats, CancellationToken, RequestCancelledError
+import job_queue
+from chat_history import (
+    compact_history,
+    render_history_detail,
+    render_success_message,
+    render_variations_message,
+    resolve_superseded,
+    status_message,
+)
+import refinement
+from postprocess import ImagePostProcessor, load_config as load_postprocess_config
+from history_index import HistoryIndex, parse_query
+from replay import ReplayRecorder, RequestRecord
 
 # 環境変数を読み込み
 load_dotenv()
 
+# バリエーション生成で一度に作成する案の上限（1回のChatGPT呼び出しの出力量を抑える）
+MAX_VARIATION_COUNT = 8
+
+
+def _env_flag(name: str, default: bool = False) -> bool:
+    """真偽値の環境変数を取得"""
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
 
 class IllustrationChatService:
-    def __init__(self):
-        """イラスト生成チャットサービスを初期化"""
+    def __init__(
+        self, background: bool = True, use_job_queue: bool = None, backends: tuple = None
+    ):
+        """
+        イラスト生成チャットサービスを初期化
+
+        Args:
+            background (bool): Trueの場合、バックエンドの初期化・ウォームアップを
+                別スレッドで行い、完了を待たずに戻る（完了はreadyで通知）
+            use_job_queue (bool): Trueの場合、生成をジョブキュー経由でワーカーに任せる
+                （Noneの場合は環境変数JOB_QUEUE_ENABLEDに従う）
+            backends (tuple, optional): (ChatGPT, NovelAI)を指定すると初期化せずにそれを使う
+                （リプレイでのスタブへの差し替え用）
+        """
         print("サービスを初期化中...")
 
-        try:
+        # バックエンドはウォームアップ完了後に設定される
+        self.chatgpt = None
+        self.novelai = None
+        self.ready = threading.Event()
+        # 初期化の終了（成功・失敗とも）と失敗時の理由
+        self.startup_finished = threading.Event()
+        self.startup_error = None
+
+        # セッションごとの再生成・修正の対象（最後に生成したプロンプト情報と入力）
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+        # セッションごとの実行中リクエストとキャンセル統計
+        self._active_tokens = {}
+        self._tokens_lock = threading.Lock()
+        self.cancellation_stats = CancellationStats()
+
+        # NovelAIはアカウントごとの同時生成数に制限があるため、プロセス全体で枠を共有
+        self._novelai_slots = threading.Semaphore(
+            int(os.getenv("NOVELAI_MAX_CONCURRENCY", 1))
+        )
+
+        # 生成履歴の索引（一覧用のサムネイルは後処理で保存時に作成）
+        self.history = HistoryIndex() if _env_flag("HISTORY_ENABLED", True) else None
+        postprocess_config = load_postprocess_config()
+        if self.history is not None and "thumbnail" not in postprocess_config["steps"]:
+            postprocess_config["steps"].append("thumbnail")
+
+        # 画像の後処理（プロセスプールは最初の保存時に起動）
+        self.postprocessor = ImagePostProcessor(postprocess_config)
+
+        # リクエストの記録（REPLAY_RECORD_PATHを設定した場合のみ）
+        self.recorder = ReplayRecorder.from_env()
+
+        if use_job_queue is None:
+            use_job_queue = _env_flag("JOB_QUEUE_ENABLED")
+        if use_job_queue:
+            # 生成はワーカープロセスが行うため、このプロセスではバックエンドを初期化しない
+            self.job_queue = job_queue.SQLiteJobQueue()
+            print(f"📥 ジョブキューモード: {self.job_queue.path}")
+            self.ready.set()
+            self.startup_finished.set()
+            return
+        self.job_queue = None
+
+        if backends is not None:
+            self.chatgpt, self.novelai = backends
+            self.ready.set()
+            self.startup_finished.set()
+            return
+
+        if background:
+            threading.Thread(
+                target=self._initialize_backends, name="backend-warmup", daemon=True
+            ).start()
+        else:
+            self._initialize_backends()
+
+    def _init_chatgpt(self):
+        """ChatGPTを初期化（ウォームアップに失敗した場合も初期化済みのクライアントは使う）"""
+        with profiler.measure("ChatGPT初期化"):
             self.chatgpt = ChatGPTProcessor()
-            print("✓ ChatGPT初期化完了")
-        except Exception as e:
-            print(f"✗ ChatGPT初期化エラー: {e}")
-            self.chatgpt = None
+        print("✓ ChatGPT初期化完了")
 
-        # DanbotNL処理を削除
+        if _env_flag("STARTUP_PREWARM"):
+            with profiler.measure("OpenAI接続ウォームアップ"):
+                if not self.chatgpt.warm_up():
+                    raise RuntimeError("OpenAI APIへの接続ウォームアップに失敗しました")
 
-        try:
+    def _init_novelai(self):
+        """NovelAIを初期化（事前ログインに失敗した場合も初期化済みのクライアントは使う）"""
+        with profiler.measure("NovelAI初期化"):
             self.novelai = NovelAIGenerator()
-            print("✓ NovelAI初期化完了")
-        except Exception as e:
-            print(f"✗ NovelAI初期化エラー: {e}")
-            self.novelai = None
+        print("✓ NovelAI初期化完了")
+
+        if _env_flag("NOVELAI_PRELOGIN"):
+            with profiler.measure("NovelAI事前ログイン"):
+                if not self.novelai.prelogin():
+                    raise RuntimeError("NovelAIへの事前ログインに失敗しました")
+
+    def _initialize_backends(self):
+        """
+        ChatGPT・NovelAIの初期化とウォームアップを並行実行
+
+        全て成功した場合だけreadyを立てる。失敗した場合はstartup_errorに理由を残し、
+        初期化できたバックエンドだけで処理を続ける（readyは立てない）。
+        """
+        errors = []
+        with profiler.measure("バックエンド初期化・ウォームアップ"):
+            with ThreadPoolExecutor(
+                max_workers=2, thread_name_prefix="backend-init"
+            ) as executor:
+                futures = {
+                    "ChatGPT": executor.submit(self._init_chatgpt),
+                    "NovelAI": executor.submit(self._init_novelai),
+                }
+                for name, future in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"✗ {name}初期化エラー: {e}")
+                        errors.append(f"{name}: {e}")
+
+        if errors:
+            self.startup_error = " / ".join(errors)
+            self.startup_finished.set()
+            print(f"❌ サービス初期化に失敗しました: {self.startup_error}")
+            return
+
+        self.ready.set()
+        self.startup_finished.set()
+        print(f"サービス初期化完了: 起動から{profiler.elapsed():.2f}秒")
 
-        # 最後に生成したプロンプト情報を保存
-        self.last_prompt_data = None
-        self.last_user_input = None
+        # コンテナのreadinessProbe用にファイルで準備完了を通知
+        ready_file = os.getenv("STARTUP_READY_FILE")
+        if ready_file:
+            try:
+                with open(ready_file, "w") as f:
+                    f.write(datetime.now().isoformat())
+            except Exception as e:
+                print(f"❌ 準備完了ファイルの書き込みエラー: {e}")
 
-        print("サービス初期化完了")
+    def is_ready(self) -> bool:
+        """バックエンドの初期化・ウォームアップが成功しているか"""
+        return self.ready.is_set()
 
-    def save_generated_image(self, image_data: bytes) -> str:
+    def wait_until_ready(self, timeout: float = None) -> bool:
         """
-        生成された画像をoutputsディレクトリに保存
+        バックエンドの初期化・ウォームアップの終了を待つ
+
+        Returns:
+            bool: 成功した場合True（失敗・タイムアウトの場合はFalse）
+        """
+        if timeout is None:
+            timeout = float(os.getenv("STARTUP_READY_TIMEOUT", 120))
+        self.startup_finished.wait(timeout)
+        return self.ready.is_set()
+
+    def _session(self, session_id: str) -> dict:
+        """
+        セッションの状態
+
+        prompt_data / user_input: 再生成・修正の対象（最後のプロンプト情報とその入力）
+        variations: 最後のバリエーション生成の結果（ギャラリーの表示順に (プロンプト情報, 入力, 画像パス)）
+        """
+        with self._sessions_lock:
+            return self._sessions.setdefault(
+                session_id, {"prompt_data": None, "user_input": None, "variations": []}
+            )
+
+    def remember_prompt(self, session_id: str, prompt_data: dict, user_input: str):
+        """セッションの再生成・修正の対象を設定"""
+        state = self._session(session_id)
+        state["prompt_data"] = prompt_data
+        state["user_input"] = user_input
+
+    def get_last_prompt(self, session_id: str) -> tuple:
+        """セッションの再生成・修正の対象を取得（未生成なら (None, None)）"""
+        state = self._session(session_id)
+        return state["prompt_data"], state["user_input"]
+
+    def forget_session(self, session_id: str):
+        """タブを閉じたセッションの状態を破棄"""
+        with self._sessions_lock:
+            self._sessions.pop(session_id, None)
+
+    def _unavailable_message(self, name: str) -> str:
+        """バックエンドが使えない場合のメッセージ（初期化に失敗していればその理由も表示）"""
+        message = f"❌ {name}が利用できません。"
+        if self.startup_error:
+            message += f"\n\n初期化エラー: {self.startup_error}"
+        return message
+
+    def _start_request(self, session_id: str, chat_history: list) -> CancellationToken:
+        """
+        新しいリクエスト用トークンを発行（同一セッションの実行中リクエストは置き換え）
+
+        置き換えたリクエストの状態表示がchat_historyに残っていれば中断メッセージに書き換える。
+        """
+        token = CancellationToken()
+        with self._tokens_lock:
+            previous = self._active_tokens.get(session_id)
+            self._active_tokens[session_id] = token
+        if previous is not None and self._cancel_token(previous, "superseded"):
+            resolve_superseded(chat_history, previous.request_id)
+        return token
+
+    def _end_request(self, session_id: str, token: CancellationToken):
+        """リクエスト終了時の後始末"""
+        token.finish()
+        with self._tokens_lock:
+            if self._active_tokens.get(session_id) is token:
+                del self._active_tokens[session_id]
+
+    def _cancel_token(self, token: CancellationToken, reason: str) -> bool:
+        """トークンをキャンセル（完了済み・キャンセル済みの場合はFalse）"""
+        stage = token.stage
+        if token.cancel(reason):
+            self.cancellation_stats.record(stage, reason)
+            print(f"🛑 リクエストをキャンセルしました (段階: {stage}, 理由: {reason})")
+            return True
+        return False
+
+    def cancel_session(self, session_id: str, reason: str = "cancelled") -> bool:
+        """
+        セッションの実行中リクエストをキャンセル
+
+        Args:
+            session_id (str): GradioのセッションID
+            reason (str): キャンセル理由（cleared, disconnected など）
+
+        Returns:
+            bool: キャンセル対象のリクエストがあった場合True
+        """
+        with self._tokens_lock:
+            token = self._active_tokens.get(session_id)
+        if token is None:
+            return False
+        self._cancel_token(token, reason)
+        return True
+
+    def get_cancellation_stats(self) -> dict:
+        """キャンセル件数（到達段階・理由別）を取得"""
+        return self.cancellation_stats.snapshot()
+
+    def get_routing_stats(self) -> dict:
+        """LLMルーティングの判定件数・昇格件数・階層別の平均レイテンシを取得"""
+        return self.chatgpt.router.snapshot() if self.chatgpt else {}
+
+    def _generate_image(
+        self, prompt_data: dict, token: CancellationToken, record: RequestRecord = None
+    ):
+        """NovelAIの同時生成数の枠を確保してから画像を生成（枠待ちの間もキャンセル可能）"""
+        # 記録・再現できるようにseedはこちらで決める
+        seed = random.randint(1, 2**32 - 1)
+        wait_start = time.perf_counter()
+        while not self._novelai_slots.acquire(timeout=0.2):
+            token.raise_if_cancelled("novelai")
+        start = time.perf_counter()
+        try:
+            image_data = self.novelai.generate_image(
+                prompt_data, cancel_token=token, seed=seed
+            )
+        finally:
+            self._novelai_slots.release()
+        if record is not None:
+            record.add_image(
+                prompt_data,
+                seed,
+                start - wait_start,
+                time.perf_counter() - start,
+                len(image_data or b""),
+            )
+        return image_data
+
+    def _finish_record(self, record: RequestRecord, token: CancellationToken):
+        """リクエストの結果を記録（記録が無効なら何もしない）"""
+        if self.recorder is None:
+            return
+        if token.cancelled:
+            status = "cancelled"
+            record.set(cancel_reason=token.reason)
+        elif token.finished:
+            status = "ok"
+        else:
+            status = "error"
+        record.set(duration=round(time.time() - record.data["t"], 3))
+        try:
+            self.recorder.write(record, status)
+        except Exception as e:
+            print(f"⚠️ リクエストの記録に失敗しました: {e}")
+
+    def save_generated_image(
+        self,
+        image_data: bytes,
+        name_suffix: str = "",
+        metadata: dict = None,
+        user_input: str = "",
+    ) -> str:
+        """
+        生成された画像をoutputsディレクトリに保存し、後処理パイプラインを適用
 
         Args:
             image_data (bytes): 画像のバイナリデータ
+            name_suffix (str): ファイル名の末尾に付ける識別子（同時刻の保存で衝突しないように）
+            metadata (dict, optional): 後処理で画像に埋め込む情報（構造化プロンプト）
+            user_input (str): 履歴に登録するユーザーの入力
 
         Returns:
-            str: 保存されたファイルのパス
+            str: 保存されたファイルのパス（後処理で形式が変わった場合は変換後のパス）
         """
         # outputsディレクトリを作成（存在しない場合）
         outputs_dir = "outputs"
@@ -60,6 +360,8 @@ class IllustrationChatService:
 
         # ファイル名を生成（タイムスタンプ付き）
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        if name_suffix:
+            timestamp = f"{timestamp}_{name_suffix}"
         filename = f"generated_image_{timestamp}.png"
         filepath = os.path.join(outputs_dir, filename)
 
@@ -68,18 +370,234 @@ class IllustrationChatService:
             with open(filepath, "wb") as f:
                 f.write(image_data)
             print(f"💾 画像を保存しました: {filepath}")
-            return filepath
         except Exception as e:
             print(f"❌ 画像保存エラー: {e}")
             return ""
 
-    def process_user_request(self, user_input: str, chat_history: list):
+        # デコード・再エンコードは別プロセスで行い、ここではパスだけを受け渡す
+        try:
+            result = self.postprocessor.process(filepath, metadata)
+        except Exception as e:
+            print(f"⚠️ 画像の後処理に失敗しました（元の画像を使用）: {e}")
+            result = {"path": filepath, "thumbnail_path": None}
+
+        if self.history is not None:
+            try:
+                self.history.add(
+                    os.path.abspath(result["path"]),
+                    thumbnail_path=result.get("thumbnail_path")
+                    and os.path.abspath(result["thumbnail_path"]),
+                    user_input=user_input,
+                    prompt_data=metadata,
+                )
+            except Exception as e:
+                print(f"⚠️ 履歴の登録に失敗しました: {e}")
+        return result["path"]
+
+    def search_history(self, query: str = "", cursor: tuple = None) -> dict:
+        """
+        生成履歴を検索（英数字の語はタグ、それ以外は入力文として扱う）
+
+        Args:
+            query (str): 検索語（空なら全件）
+            cursor (tuple, optional): 前のページのnext_cursor（Noneなら先頭ページ）
+
+        Returns:
+            dict: entries（新しい順）, next_cursor（最後のページならNone）, page_size,
+                total（先頭ページの場合のみ、それ以外はNone）
+        """
+        page_size = int(os.getenv("HISTORY_PAGE_SIZE", 24))
+        if self.history is None:
+            return {"entries": [], "next_cursor": None, "page_size": page_size, "total": 0}
+
+        tags, text = parse_query(query)
+        entries, next_cursor = self.history.search(tags, text, cursor, page_size)
+        # 件数の集計はページ送りのたびには行わない
+        total = self.history.count(tags, text) if cursor is None else None
+        return {
+            "entries": entries,
+            "next_cursor": next_cursor,
+            "page_size": page_size,
+            "total": total,
+        }
+
+    def use_history_entry(self, image_id: int, session_id: str = "default"):
+        """
+        履歴の画像のプロンプトをセッションの再生成・修正の対象にする
+
+        Returns:
+            dict: 履歴のエントリー（プロンプト情報がない場合はNone）
+        """
+        entry = self.history.get(image_id) if self.history is not None else None
+        if entry is None or not entry["prompt_data"]:
+            return None
+        self.remember_prompt(session_id, entry["prompt_data"], entry["user_input"])
+        return entry
+
+    def refinement_base(self, user_input: str, session_id: str = "default"):
+        """修正の要望であれば、差分修正の元になるセッションの前回のプロンプトを返す"""
+        if not _env_flag("REFINEMENT_ENABLED", default=True):
+            return None
+        prompt_data, _ = self.get_last_prompt(session_id)
+        if prompt_data and refinement.looks_like_refinement(user_input):
+            return prompt_data
+        return None
+
+    def refine_prompt_data(
+        self,
+        base_prompt_data: dict,
+        instruction: str,
+        cancel_token: CancellationToken = None,
+    ):
+        """
+        前回のプロンプトに修正を差分で適用（単純な修正はLLMを呼ばずにローカルで処理）
+
+        Returns:
+            dict: 修正後のプロンプト情報（差分修正できない場合はNone）
+        """
+        patch = refinement.local_edit_patch(base_prompt_data, instruction)
+        source = "ローカル"
+        if patch is None:
+            if not self.chatgpt:
+                return None
+            patch = self.chatgpt.refine_prompt(
+                base_prompt_data, instruction, cancel_token=cancel_token
+            )
+            source = "ChatGPT"
+            if not patch:
+                return None
+
+        try:
+            prompt_data = refinement.apply_json_patch(base_prompt_data, patch)
+        except ValueError as e:
+            print(f"差分修正の適用エラー: {e}")
+            return None
+
+        print(f"✏️ 差分修正を適用しました ({source}): {patch}")
+        return prompt_data
+
+    def build_prompt_data(
+        self,
+        user_input: str,
+        cancel_token: CancellationToken = None,
+        base_prompt_data: dict = None,
+    ) -> dict:
+        """
+        ユーザーの入力を構造化プロンプトに変換（ChatGPTが使えない場合はフォールバック）
+
+        Args:
+            user_input (str): ユーザーの入力
+            cancel_token (CancellationToken, optional): キャンセル用トークン
+            base_prompt_data (dict, optional): 指定すると、このプロンプトへの差分修正として処理
+
+        Returns:
+            dict: 構造化されたプロンプト情報
+        """
+        if base_prompt_data is not None:
+            prompt_data = self.refine_prompt_data(
+                base_prompt_data, user_input, cancel_token=cancel_token
+            )
+            if prompt_data is not None:
+                return prompt_data
+            print("差分修正できなかったため、新しいリクエストとして処理します")
+
+        if self.chatgpt:
+            return self.chatgpt.enhance_illustration_prompt(
+                user_input, cancel_token=cancel_token
+            )
+
+        # フォールバック用の構造化データ（位置指定なし）
+        return {
+            "characterCount": 1,
+            "prompt": "masterpiece, best_quality, high_resolution",
+            "characterPrompts": [
+                {
+                    "prompt": user_input
+                    # positionは任意項目なので省略
+                }
+            ],
+        }
+
+    def _run_job(self, payload: dict, token: CancellationToken):
+        """
+        ジョブキューにジョブを投入し、完了まで進捗を中継する
+
+        進捗メッセージ(str)を順にyieldし、最後にジョブの結果(dict)をyieldする。
+        トークンがキャンセルされるとジョブもキャンセルされる。
+        JOB_WAIT_TIMEOUT秒以内にワーカーが取得しなかったジョブ（リースが切れたまま
+        再取得されないジョブを含む）はキャンセルしてエラーにする。
+        """
+        job_id = self.job_queue.enqueue(payload)
+        token.add_callback(lambda: self.job_queue.cancel(job_id))
+        poll_interval = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+        wait_timeout = float(os.getenv("JOB_WAIT_TIMEOUT", 300))
+        # ワーカーの取得を待ち始めた時刻（ワーカーが処理中の間はNone）
+        waiting_since = time.monotonic()
+
+        last_message = None
+        while True:
+            job = self.job_queue.get(job_id)
+            state = job["state"]
+
+            if state == job_queue.DONE:
+                yield job["result"]
+                return
+            if state == job_queue.FAILED:
+                raise RuntimeError(job["error"] or "ジョブが失敗しました")
+            if state == job_queue.CANCELLED:
+                token.raise_if_cancelled()
+                raise RequestCancelledError(token.stage, "cancelled")
+
+            # 処理中のワーカーが落ちてリースが切れた場合も、再取得を待つ間は待機中と同じ扱い
+            lease_expired = state == job_queue.RUNNING and job["lease_expires_at"] < time.time()
+            if state == job_queue.QUEUED or lease_expired:
+                if waiting_since is None:
+                    waiting_since = time.monotonic()
+                waited = time.monotonic() - waiting_since
+                if 0 < wait_timeout <= waited:
+                    if self.job_queue.cancel(job_id):
+                        raise RuntimeError(
+                            f"{wait_timeout:.0f}秒待ってもワーカーがジョブを取得しませんでした"
+                            "（worker.pyが起動しているか確認してください）"
+                        )
+                    # キャンセルの直前にワーカーが完了・失敗させた場合は結果を確認する
+                    continue
+
+                metrics = self.job_queue.metrics()
+                if lease_expired:
+                    message = "⏳ ワーカーが応答しないため、再取得を待っています..."
+                else:
+                    message = f"⏳ 生成待ち... (待機中のジョブ: {metrics['queue_depth']}件)"
+                # 待機中のジョブがあるのに処理中のジョブがなければ、ワーカーが動いていない
+                live_workers = metrics["running"] - metrics["expired_leases"]
+                if live_workers == 0 and waited >= 5:
+                    message += "\n\n⚠️ 処理中のワーカーがいません。worker.pyが起動しているか確認してください"
+            else:
+                waiting_since = None
+                token.stage = job["stage"] or "running"
+                message = job["status_message"] or "⚙️ ワーカーで処理中..."
+
+            if message != last_message:
+                last_message = message
+                yield message
+
+            if token.wait(poll_interval):
+                token.raise_if_cancelled()
+
+    def get_queue_metrics(self) -> dict:
+        """ジョブキューの深さ等を取得（ジョブキューモード以外では空）"""
+        return self.job_queue.metrics() if self.job_queue else {}
+
+    def process_user_request(
+        self, user_input: str, chat_history: list, session_id: str = "default"
+    ):
         """
         ユーザーのリクエストを処理してイラストを生成
 
         Args:
             user_input (str): ユーザーの入力
             chat_history (list): チャット履歴
+            session_id (str): セッションID（同一セッションの新規リクエストで古い処理をキャンセル）
 
         Returns:
             tuple: (更新されたチャット履歴, 空文字列, 生成された画像)
@@ -95,101 +613,150 @@ class IllustrationChatService:
             yield chat_history, "", None
             return
 
+        # 古いメッセージを要約にまとめ、以降のyieldで変化するのは最後のメッセージだけにする
+        # （この後に追加するユーザーの入力と返答の2件分を空けておく）
+        compact_history(chat_history, reserve=2)
+
         # チャット履歴にユーザーの入力を追加
         chat_history.append({"role": "user", "content": user_input})
 
-        try:
-            # ステップ1: ChatGPTでイラスト内容を補完
-            status_message = "🤖 ChatGPTでイラスト内容を補完中..."
-            chat_history.append({"role": "assistant", "content": status_message})
-            yield chat_history, "", None
-
-            if self.chatgpt:
-                prompt_data = self.chatgpt.enhance_illustration_prompt(user_input)
-            else:
-                # フォールバック用の構造化データ（位置指定なし）
-                prompt_data = {
-                    "characterCount": 1,
-                    "prompt": "masterpiece, best_quality, high_resolution",
-                    "characterPrompts": [
-                        {
-                            "prompt": user_input
-                            # positionは任意項目なので省略
-                        }
-                    ],
-                }
-
-            # ステップ2: NovelAI v4.5でキャラクター座標対応画像生成
-            status_message = "🎨 NovelAI v4.5で画像生成中..."
-            chat_history[-1]["content"] = status_message
-            yield chat_history, "", None
+        # 「髪を赤にして」のような修正の要望は前回のプロンプトへの差分として処理
+        base_prompt_data = self.refinement_base(user_input, session_id)
 
-            if self.novelai:
-                # 構造化プロンプトデータをNovelAIに渡す
-                image_data = self.novelai.generate_image(prompt_data)
-
-                if image_data:
-                    # 成功した場合、最後のプロンプト情報を保存
-                    self.last_prompt_data = prompt_data
-                    self.last_user_input = user_input
-
-                    # PIL Imageに変換
-                    image = self.novelai.image_to_pil(image_data)
-
-                    # outputsディレクトリに画像を保存
-                    self.save_generated_image(image_data)
+        token = self._start_request(session_id, chat_history)
+        record = RequestRecord("generate", user_input, session_id)
+        try:
+            if not self.startup_finished.is_set():
+                chat_history.append(
+                    status_message("⏳ バックエンドを準備中...", token.request_id)
+                )
+                yield chat_history, "", None
+                self.wait_until_ready()
+                chat_history.pop()
 
-                    # 成功メッセージ
-                    character_info = ""
-                    for i, char in enumerate(prompt_data.get("characterPrompts", [])):
-                        position = char.get("position")
-                        position_text = (
-                            f" (位置: {position})" if position else " (位置指定なし)"
-                        )
-                        character_info += f"**キャラクター{i + 1}**{position_text}: {char.get('prompt', '')}\n"
+            if self.job_queue is not None:
+                # ジョブキューモード: ChatGPT・NovelAIの処理はワーカープロセスで行う
+                chat_history.append(
+                    status_message("📥 生成ジョブを投入しました", token.request_id)
+                )
+                yield chat_history, "", None
 
-                    success_message = f"""
-✅ **イラスト生成完了！**
+                result = None
+                payload = {"user_input": user_input}
+                if base_prompt_data is not None:
+                    payload["base_prompt_data"] = base_prompt_data
+                with record.stage("job"):
+                    for update in self._run_job(payload, token):
+                        if isinstance(update, dict):
+                            result = update
+                        else:
+                            chat_history[-1]["content"] = update
+                            yield chat_history, "", None
+
+                prompt_data = result["prompt_data"]
+                record.set_prompt(prompt_data, PRESET_SETTINGS)
+                # 画像はワーカーが保存したファイルのパスをそのまま表示に使う
+                image = result["image_path"]
+            else:
+                # ステップ1: ChatGPTでイラスト内容を補完（修正の要望なら前回のプロンプトを差分修正）
+                if base_prompt_data is not None:
+                    status_text = "✏️ 前回のプロンプトを修正中..."
+                else:
+                    status_text = "🤖 ChatGPTでイラスト内容を補完中..."
+                chat_history.append(status_message(status_text, token.request_id))
+                yield chat_history, "", None
 
-**キャラクター数:** {prompt_data.get("characterCount", 1)}
+                token.enter_stage("chatgpt")
+                with record.stage("chatgpt"):
+                    prompt_data = self.build_prompt_data(
+                        user_input, cancel_token=token, base_prompt_data=base_prompt_data
+                    )
+                record.set_prompt(prompt_data, PRESET_SETTINGS)
 
-**背景・環境:**
-{prompt_data.get("prompt", "")}
+                # ステップ2: NovelAI v4.5でキャラクター座標対応画像生成
+                status_text = "🎨 NovelAI v4.5で画像生成中..."
+                chat_history[-1]["content"] = status_text
+                yield chat_history, "", None
 
-{character_info}
+                if not self.novelai:
+                    chat_history[-1]["content"] = self._unavailable_message("NovelAI API")
+                    yield chat_history, "", None
+                    return
 
-**生成時刻:** {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-"""
-                    chat_history[-1]["content"] = success_message
-                    yield chat_history, "", image
+                # 構造化プロンプトデータをNovelAIに渡す（キャンセル済みならここで中断）
+                token.enter_stage("novelai")
+                image_data = self._generate_image(prompt_data, token, record)
 
-                else:
+                if not image_data:
                     error_message = (
                         "❌ 画像生成に失敗しました。APIキーや設定を確認してください。"
                     )
                     chat_history[-1]["content"] = error_message
                     yield chat_history, "", None
-            else:
-                error_message = "❌ NovelAI APIが利用できません。"
-                chat_history[-1]["content"] = error_message
-                yield chat_history, "", None
+                    return
+
+                # 生成後にキャンセルされた場合は保存しない
+                token.enter_stage("saving")
+
+                # outputsディレクトリに保存し、表示にはファイルのパスを渡す
+                with record.stage("saving"):
+                    image = self.save_generated_image(
+                        image_data, metadata=prompt_data, user_input=user_input
+                    )
+                if not image:
+                    image = self.novelai.image_to_pil(image_data)
 
+            # 成功した場合、最後のプロンプト情報をセッションに保存
+            self.remember_prompt(session_id, prompt_data, user_input)
+
+            # 成功メッセージ
+            success_message = render_success_message(prompt_data)
+            chat_history[-1]["content"] = success_message
+            # 保存中に置き換えられた場合は、完了メッセージで新しいリクエストの表示を上書きしない
+            token.raise_if_cancelled()
+            token.finish()
+            yield chat_history, "", image
+
+        except RequestCancelledError as e:
+            if token.reason == "superseded":
+                # 置き換えたリクエストがチャットを引き継ぐため、古い履歴では上書きしない
+                return
+            chat_history[-1]["content"] = f"🛑 生成をキャンセルしました (段階: {e.stage})"
+            yield chat_history, "", None
+        except GeneratorExit:
+            # Gradioのキャンセル・切断でジェネレーターが閉じられた
+            self._cancel_token(token, "closed")
+            raise
         except Exception as e:
             error_message = f"❌ エラーが発生しました: {str(e)}"
             chat_history[-1]["content"] = error_message
             yield chat_history, "", None
-
-    def regenerate_image(self, chat_history: list):
+        finally:
+            self._finish_record(record, token)
+            self._end_request(session_id, token)
+
+    def regenerate_image(
+        self,
+        chat_history: list,
+        session_id: str = "default",
+        prompt_data: dict = None,
+        user_input: str = None,
+    ):
         """
-        最後のプロンプトで画像を再生成（GPT-5を経由せず）
+        セッションの最後のプロンプトで画像を再生成（GPT-5を経由せず）
 
         Args:
             chat_history (list): チャット履歴
+            session_id (str): セッションID
+            prompt_data (dict, optional): 指定するとセッションの状態ではなくこのプロンプトで再生成
+            user_input (str, optional): prompt_dataの元の入力
 
         Returns:
             tuple: (更新されたチャット履歴, 生成された画像)
         """
-        if not self.last_prompt_data:
+        if prompt_data is None:
+            prompt_data, user_input = self.get_last_prompt(session_id)
+        if not prompt_data:
             # 再生成可能なプロンプトがない場合
             chat_history.append(
                 {
@@ -200,58 +767,70 @@ class IllustrationChatService:
             yield chat_history, None
             return
 
-        if not self.novelai:
+        # 再生成は初回生成の後なので、通常は初期化済み
+        self.wait_until_ready()
+
+        if self.job_queue is None and not self.novelai:
             # NovelAI APIが利用できない場合
             chat_history.append(
-                {"role": "assistant", "content": "❌ NovelAI APIが利用できません。"}
+                {"role": "assistant", "content": self._unavailable_message("NovelAI API")}
             )
             yield chat_history, None
             return
 
+        compact_history(chat_history, reserve=1)
+
+        token = self._start_request(session_id, chat_history)
+        record = RequestRecord("regenerate", user_input, session_id)
+        record.set_prompt(prompt_data, PRESET_SETTINGS)
         try:
             # ステータスメッセージを表示
-            status_message = (
-                f"🔄 同じ条件で再生成中...\n\n**元の入力:** {self.last_user_input}"
+            status_text = (
+                f"🔄 同じ条件で再生成中...\n\n**元の入力:** {user_input}"
             )
-            chat_history.append({"role": "assistant", "content": status_message})
+            chat_history.append(status_message(status_text, token.request_id))
             yield chat_history, None
 
-            # NovelAIで再生成（seedは自動的に異なる値になる）
-            image_data = self.novelai.generate_image(self.last_prompt_data)
-
-            if image_data:
-                # PIL Imageに変換
-                image = self.novelai.image_to_pil(image_data)
-
-                # outputsディレクトリに画像を保存
-                self.save_generated_image(image_data)
+            if self.job_queue is not None:
+                # 構造化済みのプロンプトを渡し、ワーカーでのChatGPT処理を省略させる
+                payload = {
+                    "user_input": user_input,
+                    "prompt_data": prompt_data,
+                }
+                image = None
+                with record.stage("job"):
+                    for update in self._run_job(payload, token):
+                        if isinstance(update, dict):
+                            image = update["image_path"]
+                        else:
+                            chat_history[-1]["content"] = f"{status_text}\n\n{update}"
+                            yield chat_history, None
+            else:
+                # NovelAIで再生成（seedは自動的に異なる値になる）
+                token.enter_stage("novelai")
+                image_data = self._generate_image(prompt_data, token, record)
+                image = None
+                if image_data:
+                    token.enter_stage("saving")
+
+                    # outputsディレクトリに保存し、表示にはファイルのパスを渡す
+                    with record.stage("saving"):
+                        image = self.save_generated_image(
+                            image_data,
+                            metadata=prompt_data,
+                            user_input=user_input,
+                        )
+                    if not image:
+                        image = self.novelai.image_to_pil(image_data)
 
+            if image is not None:
                 # 成功メッセージ
-                character_info = ""
-                for i, char in enumerate(
-                    self.last_prompt_data.get("characterPrompts", [])
-                ):
-                    position = char.get("position")
-                    position_text = (
-                        f" (位置: {position})" if position else " (位置指定なし)"
-                    )
-                    character_info += f"**キャラクター{i + 1}**{position_text}: {char.get('prompt', '')}\n"
-
-                success_message = f"""
-✅ **再生成完了！** (GPT-5処理をスキップ)
-
-**元の入力:** {self.last_user_input}
-
-**キャラクター数:** {self.last_prompt_data.get("characterCount", 1)}
-
-**背景・環境:**
-{self.last_prompt_data.get("prompt", "")}
-
-{character_info}
-
-**生成時刻:** {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-"""
+                success_message = render_success_message(
+                    prompt_data, user_input=user_input
+                )
                 chat_history[-1]["content"] = success_message
+                token.raise_if_cancelled()
+                token.finish()
                 yield chat_history, image
 
             else:
@@ -261,15 +840,199 @@ class IllustrationChatService:
                 chat_history[-1]["content"] = error_message
                 yield chat_history, None
 
+        except RequestCancelledError as e:
+            if token.reason == "superseded":
+                return
+            chat_history[-1]["content"] = f"🛑 再生成をキャンセルしました (段階: {e.stage})"
+            yield chat_history, None
+        except GeneratorExit:
+            self._cancel_token(token, "closed")
+            raise
         except Exception as e:
             error_message = f"❌ 再生成エラーが発生しました: {str(e)}"
             chat_history[-1]["content"] = error_message
             yield chat_history, None
+        finally:
+            self._finish_record(record, token)
+            self._end_request(session_id, token)
+
+    def generate_variations(
+        self,
+        user_input: str,
+        chat_history: list,
+        session_id: str = "default",
+        count: int = None,
+    ):
+        """
+        1回のChatGPT呼び出しで構図の異なる複数の案を作成し、NovelAIで並行して生成
+
+        完成した画像から順にギャラリーへ追加する。
+
+        Args:
+            user_input (str): ユーザーの入力
+            chat_history (list): チャット履歴
+            session_id (str): セッションID
+            count (int, optional): 案の数（Noneの場合は環境変数VARIATION_COUNT、1〜MAX_VARIATION_COUNTに丸める）
+
+        Returns:
+            tuple: (更新されたチャット履歴, 空文字列, ギャラリーの画像リスト)
+        """
+        if not user_input.strip():
+            chat_history.append(
+                {
+                    "role": "assistant",
+                    "content": "⚠️ イラストの内容を入力してください。\n\n例: 「猫の女の子が花畑で笑っている」",
+                }
+            )
+            yield chat_history, "", None
+            return
+
+        if count is None:
+            count = int(os.getenv("VARIATION_COUNT", 4))
+        count = min(max(count, 1), MAX_VARIATION_COUNT)
+
+        compact_history(chat_history, reserve=2)
+        chat_history.append({"role": "user", "content": user_input})
+
+        token = self._start_request(session_id, chat_history)
+        record = RequestRecord("variations", user_input, session_id)
+        executor = None
+        try:
+            if not self.startup_finished.is_set():
+                chat_history.append(
+                    status_message("⏳ バックエンドを準備中...", token.request_id)
+                )
+                yield chat_history, "", None
+                self.wait_until_ready()
+                chat_history.pop()
+
+            if self.job_queue is not None or not self.chatgpt or not self.novelai:
+                chat_history.append(
+                    {
+                        "role": "assistant",
+                        "content": "❌ バリエーション生成にはChatGPT・NovelAI APIが必要です（ジョブキューモードには未対応）。",
+                    }
+                )
+                yield chat_history, "", None
+                return
+
+            chat_history.append(
+                status_message(f"🤖 ChatGPTで{count}通りの案を作成中...", token.request_id)
+            )
+            yield chat_history, "", None
+
+            token.enter_stage("chatgpt")
+            with record.stage("chatgpt"):
+                variations = self.chatgpt.enhance_illustration_variations(
+                    user_input, count, cancel_token=token
+                )
+            chat_history[-1]["content"] = render_variations_message(
+                user_input, variations, set()
+            )
+            yield chat_history, "", None
+
+            # 完成するたびに追加し、生成中でもギャラリーから選べるようにする
+            # （置き換えられた古いリクエストが書き込まないよう、リクエストごとに新しいリストにする）
+            selectable = []
+            self._session(session_id)["variations"] = selectable
+
+            # 同時生成数は_novelai_slotsで制限し、完成した順に表示
+            token.enter_stage("novelai")
+            executor = ThreadPoolExecutor(
+                max_workers=len(variations), thread_name_prefix="variation"
+            )
+            futures = {
+                executor.submit(self._generate_image, variation, token, record): i
+                for i, variation in enumerate(variations)
+            }
+            completed = []
+            gallery = []
+            for future in as_completed(futures):
+                token.raise_if_cancelled()
+                index = futures[future]
+                try:
+                    image_data = future.result()
+                except RequestCancelledError:
+                    raise
+                except Exception as e:
+                    print(f"❌ 案{index + 1}の生成に失敗しました: {e}")
+                    continue
+                if not image_data:
+                    continue
+
+                with record.stage("saving"):
+                    image_path = self.save_generated_image(
+                        image_data,
+                        name_suffix=f"v{index + 1}",
+                        metadata=variations[index],
+                        user_input=user_input,
+                    )
+                if not image_path:
+                    continue
+                completed.append((index, image_path))
+                selectable.append((variations[index], user_input, image_path))
+                gallery.append((image_path, f"案{index + 1}"))
+                if len(completed) == 1:
+                    # ギャラリーで選ばれるまでは最初に完成した案を再生成・修正の対象にする
+                    self.remember_prompt(session_id, variations[index], user_input)
+                chat_history[-1]["content"] = render_variations_message(
+                    user_input, variations, {i for i, _ in completed}
+                )
+                yield chat_history, "", list(gallery)
+
+            if not completed:
+                chat_history[-1]["content"] = (
+                    "❌ 画像生成に失敗しました。APIキーや設定を確認してください。"
+                )
+                yield chat_history, "", None
+                return
+
+            chat_history[-1]["content"] = render_variations_message(
+                user_input, variations, {i for i, _ in completed}, done=True
+            )
+            token.raise_if_cancelled()
+            token.finish()
+            yield chat_history, "", list(gallery)
+
+        except RequestCancelledError as e:
+            if token.reason == "superseded":
+                # 置き換えたリクエストがチャットを引き継ぐため、古い履歴では上書きしない
+                return
+            chat_history[-1]["content"] = f"🛑 生成をキャンセルしました (段階: {e.stage})"
+            yield chat_history, "", None
+        except GeneratorExit:
+            self._cancel_token(token, "closed")
+            raise
+        except Exception as e:
+            error_message = f"❌ エラーが発生しました: {str(e)}"
+            chat_history[-1]["content"] = error_message
+            yield chat_history, "", None
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+            self._finish_record(record, token)
+            self._end_request(session_id, token)
+
+    def select_variation(self, index: int, session_id: str = "default"):
+        """
+        ギャラリーで選ばれた案をセッションの再生成・修正の対象にする
+
+        Returns:
+            str: 選ばれた案の画像パス（範囲外の場合はNone）
+        """
+        variations = self._session(session_id)["variations"]
+        if not 0 <= index < len(variations):
+            return None
+        prompt_data, user_input, image_path = variations[index]
+        self.remember_prompt(session_id, prompt_data, user_input)
+        return image_path
 
 
 def create_gradio_interface():
     """Gradio WebUIを作成"""
+    # バックエンドのウォームアップを先に開始し、gradioの読み込みと並行させる
     service = IllustrationChatService()
+    gr = profiler.import_module("gradio")
 
     # カスタムCSS
     custom_css = """
@@ -329,109 +1092,329 @@ def create_gradio_interface():
 
         # メインコンテンツを中央配置のコンテナで囲む
         with gr.Column(elem_classes="main"):
-            with gr.Row():
-                with gr.Column(scale=2):
-                    chatbot = gr.Chatbot(
-                        label="チャット",
-                        height=600,
-                        show_copy_button=True,
-                        type="messages",
-                    )
+            with gr.Tabs():
+                with gr.Tab("🎨 イラスト生成"):
+                    with gr.Row():
+                        with gr.Column(scale=2):
+                            chatbot = gr.Chatbot(
+                                label="チャット",
+                                height=600,
+                                show_copy_button=True,
+                                type="messages",
+                            )
+
+                            with gr.Row():
+                                user_input = gr.Textbox(
+                                    placeholder="例: 金髪の女の子が桜の木の下で笑っている",
+                                    label="イラストの希望を入力",
+                                    lines=2,
+                                    scale=4,
+                                )
+                                submit_btn = gr.Button("生成", variant="primary", scale=1)
+                                regenerate_btn = gr.Button(
+                                    "🔄 再生成", variant="secondary", scale=1
+                                )
+                                variations_btn = gr.Button(
+                                    "🎲 バリエーション", variant="secondary", scale=1
+                                )
+
+                            gr.Examples(
+                                examples=[
+                                    "可愛い猫の女の子が花畑で笑っている",
+                                    "金髪で青い目の魔法使いが本を読んでいる",
+                                    "制服を着た女子高生が教室で勉強している",
+                                    "和服を着た美少女が竹林を歩いている",
+                                ],
+                                inputs=user_input,
+                            )
+
+                        with gr.Column(scale=1):
+                            generated_image = gr.Image(
+                                label="生成されたイラスト", type="filepath", height=600
+                            )
+
+                            download_btn = gr.DownloadButton(
+                                label="📥 画像をダウンロード",
+                                visible=False,
+                                variant="secondary",
+                            )
+
+                            variations_gallery = gr.Gallery(
+                                label="バリエーション（選ぶと再生成・修正の対象になります）",
+                                columns=2,
+                                height="auto",
+                            )
+
+                    # クリアボタンを中央配置
+                    with gr.Row():
+                        clear_btn = gr.Button(
+                            "🗑️ チャットをクリア", variant="secondary", scale=1
+                        )
 
+                with gr.Tab("📚 履歴") as history_tab:
                     with gr.Row():
-                        user_input = gr.Textbox(
-                            placeholder="例: 金髪の女の子が桜の木の下で笑っている",
-                            label="イラストの希望を入力",
-                            lines=2,
+                        history_query = gr.Textbox(
+                            placeholder="タグ（例: blonde_hair library）や入力文で検索",
+                            label="検索",
                             scale=4,
                         )
-                        submit_btn = gr.Button("生成", variant="primary", scale=1)
-                        regenerate_btn = gr.Button(
-                            "🔄 再生成", variant="secondary", scale=1
-                        )
-
-                    gr.Examples(
-                        examples=[
-                            "可愛い猫の女の子が花畑で笑っている",
-                            "金髪で青い目の魔法使いが本を読んでいる",
-                            "制服を着た女子高生が教室で勉強している",
-                            "和服を着た美少女が竹林を歩いている",
-                        ],
-                        inputs=user_input,
-                    )
-
-                with gr.Column(scale=1):
-                    generated_image = gr.Image(
-                        label="生成されたイラスト", type="pil", height=600
+                        history_search_btn = gr.Button("🔍 検索", scale=1)
+
+                    # 一覧にはサムネイルだけを表示し、元の画像は選択時に読み込む
+                    history_gallery = gr.Gallery(
+                        label="生成履歴",
+                        columns=6,
+                        height="auto",
+                        allow_preview=False,
                     )
+                    with gr.Row():
+                        history_prev_btn = gr.Button("◀ 前へ", scale=1)
+                        history_page_info = gr.Markdown()
+                        history_next_btn = gr.Button("次へ ▶", scale=1)
 
-                    download_btn = gr.DownloadButton(
-                        label="📥 画像をダウンロード",
-                        visible=False,
-                        variant="secondary",
-                    )
+                    with gr.Row():
+                        with gr.Column(scale=1):
+                            history_image = gr.Image(
+                                label="選択した画像", type="filepath", height=500
+                            )
+                        with gr.Column(scale=1):
+                            history_detail = gr.Markdown()
+                            history_use_btn = gr.Button(
+                                "🔄 このプロンプトを再生成・修正の対象にする",
+                                variant="secondary",
+                            )
+
+                    # キーセットページング用（各ページの開始カーソル、次のページのカーソル、件数）
+                    history_cursors = gr.State([None])
+                    history_next = gr.State(None)
+                    history_total = gr.State(0)
+                    history_ids = gr.State([])
+                    history_selected = gr.State(None)
 
         # イベントハンドラー
-        def submit_and_generate(user_input, chat_history):
-            for result in service.process_user_request(user_input, chat_history):
-                yield result
+        def skip_unchanged(results):
+            """
+            2回目以降のyieldでは入力欄のクリアや空の画像を送り直さない
+            （チャット履歴はGradioが差分だけを送るため、変化するのは最後のメッセージのみ）
+            """
+            for i, result in enumerate(results):
+                if i == 0:
+                    yield result
+                    continue
+                yield tuple(
+                    gr.skip() if value is None or value == "" else value
+                    for value in result
+                )
 
-        def regenerate_and_update(chat_history):
-            for result in service.regenerate_image(chat_history):
-                yield result
+        def submit_and_generate(user_input, chat_history, request: gr.Request):
+            yield from skip_unchanged(
+                service.process_user_request(
+                    user_input, chat_history, request.session_hash
+                )
+            )
 
-        def clear_chat():
+        def regenerate_and_update(chat_history, request: gr.Request):
+            yield from skip_unchanged(
+                service.regenerate_image(chat_history, request.session_hash)
+            )
+
+        def generate_variations(user_input, chat_history, request: gr.Request):
+            yield from skip_unchanged(
+                service.generate_variations(
+                    user_input, chat_history, request.session_hash
+                )
+            )
+
+        def on_variation_select(evt: gr.SelectData, request: gr.Request):
+            """ギャラリーで選んだ案を大きく表示し、以降の再生成・修正の対象にする"""
+            image_path = service.select_variation(evt.index, request.session_hash)
+            return image_path if image_path is not None else gr.skip()
+
+        def load_history(query, cursors, total):
+            """
+            履歴の1ページ分をサムネイルで表示
+
+            cursorsは先頭から現在のページまでの各ページの開始カーソル（先頭ページはNone）
+            """
+            result = service.search_history(query, cursors[-1])
+            if result["total"] is not None:
+                total = result["total"]
+            gallery = [
+                (entry["thumbnail_path"] or entry["path"], entry["user_input"][:30])
+                for entry in result["entries"]
+            ]
+            pages = max(1, -(-total // result["page_size"]))
+            page_info = f"{len(cursors)} / {pages} ページ（{total}件）"
+            ids = [entry["id"] for entry in result["entries"]]
+            return gallery, page_info, cursors, result["next_cursor"], total, ids
+
+        def load_next_history(query, cursors, next_cursor, total):
+            if next_cursor is None:
+                return load_history(query, cursors, total)
+            return load_history(query, cursors + [next_cursor], total)
+
+        def load_prev_history(query, cursors, total):
+            return load_history(query, cursors[:-1] or [None], total)
+
+        def on_history_select(ids, evt: gr.SelectData):
+            """選択された履歴の元画像とプロンプトを表示"""
+            if not 0 <= evt.index < len(ids) or service.history is None:
+                return None, "", None
+            entry = service.history.get(ids[evt.index])
+            if entry is None:
+                return None, "⚠️ 履歴が見つかりません", None
+            created_at = datetime.fromtimestamp(entry["created_at"])
+            detail = f"**入力:** {entry['user_input'] or '(不明)'}\n\n"
+            if entry["prompt_data"]:
+                detail += render_history_detail(entry["prompt_data"])
+            detail += f"\n\n**生成時刻:** {created_at.strftime('%Y-%m-%d %H:%M:%S')}"
+            image_path = entry["path"] if os.path.exists(entry["path"]) else None
+            return image_path, detail, entry["id"]
+
+        def use_history_entry(image_id, request: gr.Request):
+            if image_id is None:
+                gr.Warning("履歴の画像を選択してください")
+            elif service.use_history_entry(image_id, request.session_hash) is None:
+                gr.Warning("この画像にはプロンプト情報がありません")
+            else:
+                gr.Info("このプロンプトを再生成・修正の対象にしました")
+
+        def clear_chat(request: gr.Request):
+            service.cancel_session(request.session_hash, "cleared")
             return [], ""
 
+        def on_unload(request: gr.Request):
+            """タブを閉じたときに実行中のリクエストをキャンセルし、セッションの状態を破棄"""
+            service.cancel_session(request.session_hash, "disconnected")
+            service.forget_session(request.session_hash)
+
         def on_image_change(image):
             """画像が変更されたときのハンドラー"""
             if image is not None:
-                # 画像ファイルを一時保存してダウンロード用のパスを生成
-                import tempfile
-                import uuid
-
-                # 一意なファイル名を生成
-                filename = f"generated_image_{uuid.uuid4().hex[:8]}.png"
-                filepath = os.path.join(tempfile.gettempdir(), filename)
-
-                # PIL画像を保存
-                image.save(filepath, "PNG")
-
+                # 保存済みの画像ファイルをそのままダウンロード対象にする（再エンコードしない）
                 return gr.DownloadButton(
-                    label="📥 画像をダウンロード", value=filepath, visible=True
+                    label="📥 画像をダウンロード", value=image, visible=True
                 )
             else:
                 return gr.DownloadButton(label="📥 画像をダウンロード", visible=False)
 
-        # クリアボタンを中央配置
-        with gr.Row():
-            clear_btn = gr.Button("🗑️ チャットをクリア", variant="secondary", scale=1)
+        # 生成系のイベントは実行中でも次のトリガーを受け付け、同じ同時実行枠で並行して動かす
+        # （同一セッションの新しいリクエストが_start_requestで古い処理を置き換えられるように）
+        concurrency_limit = os.getenv("GRADIO_CONCURRENCY_LIMIT")
+        if concurrency_limit:
+            concurrency_limit = int(concurrency_limit)
+        elif service.job_queue is not None:
+            # ジョブキューモードでは待機はキューで行うため、ワーカーを増やした分だけ並行処理できるよう制限しない
+            concurrency_limit = None
+        else:
+            concurrency_limit = 4
+        generation_options = {
+            "trigger_mode": "multiple",
+            "concurrency_id": "generation",
+            "concurrency_limit": concurrency_limit,
+        }
 
         # イベントハンドラー設定
-        submit_btn.click(
+        submit_event = submit_btn.click(
             submit_and_generate,
             inputs=[user_input, chatbot],
             outputs=[chatbot, user_input, generated_image],
-        ).then(on_image_change, inputs=[generated_image], outputs=[download_btn])
+            **generation_options,
+        )
+        submit_event.then(
+            on_image_change, inputs=[generated_image], outputs=[download_btn]
+        )
 
-        user_input.submit(
+        enter_event = user_input.submit(
             submit_and_generate,
             inputs=[user_input, chatbot],
             outputs=[chatbot, user_input, generated_image],
-        ).then(on_image_change, inputs=[generated_image], outputs=[download_btn])
+            **generation_options,
+        )
+        enter_event.then(
+            on_image_change, inputs=[generated_image], outputs=[download_btn]
+        )
 
-        regenerate_btn.click(
+        regenerate_event = regenerate_btn.click(
             regenerate_and_update,
             inputs=[chatbot],
             outputs=[chatbot, generated_image],
+            **generation_options,
+        )
+        regenerate_event.then(
+            on_image_change, inputs=[generated_image], outputs=[download_btn]
+        )
+
+        variations_event = variations_btn.click(
+            generate_variations,
+            inputs=[user_input, chatbot],
+            outputs=[chatbot, user_input, variations_gallery],
+            **generation_options,
+        )
+
+        variations_gallery.select(
+            on_variation_select, inputs=None, outputs=[generated_image]
         ).then(on_image_change, inputs=[generated_image], outputs=[download_btn])
 
-        clear_btn.click(clear_chat, inputs=[], outputs=[chatbot, user_input]).then(
-            lambda: gr.DownloadButton(label="📥 画像をダウンロード", visible=False),
+        clear_btn.click(
+            clear_chat,
+            inputs=[],
+            outputs=[chatbot, user_input],
+            # 実行中の生成イベントも停止し、待機中のリクエストはキューから外す
+            cancels=[submit_event, enter_event, regenerate_event, variations_event],
+        ).then(
+            lambda: (
+                gr.DownloadButton(label="📥 画像をダウンロード", visible=False),
+                None,
+            ),
             inputs=[],
-            outputs=[download_btn],
+            outputs=[download_btn, variations_gallery],
         )
 
+        # 履歴タブは開いたときに読み込む
+        history_outputs = [
+            history_gallery,
+            history_page_info,
+            history_cursors,
+            history_next,
+            history_total,
+            history_ids,
+        ]
+        # タブを開いたとき・検索したときは先頭ページから表示
+        history_tab.select(
+            lambda query: load_history(query, [None], 0),
+            inputs=[history_query],
+            outputs=history_outputs,
+        )
+        history_search_btn.click(
+            lambda query: load_history(query, [None], 0),
+            inputs=[history_query],
+            outputs=history_outputs,
+        )
+        history_query.submit(
+            lambda query: load_history(query, [None], 0),
+            inputs=[history_query],
+            outputs=history_outputs,
+        )
+        history_prev_btn.click(
+            load_prev_history,
+            inputs=[history_query, history_cursors, history_total],
+            outputs=history_outputs,
+        )
+        history_next_btn.click(
+            load_next_history,
+            inputs=[history_query, history_cursors, history_next, history_total],
+            outputs=history_outputs,
+        )
+        history_gallery.select(
+            on_history_select,
+            inputs=[history_ids],
+            outputs=[history_image, history_detail, history_selected],
+        )
+        history_use_btn.click(use_history_entry, inputs=[history_selected], outputs=None)
+
+        demo.unload(on_unload)
+
     return demo
 
 
@@ -462,6 +1445,9 @@ def main():
 
     # Gradio WebUIを作成
     demo = create_gradio_interface()
+    print(f"⏱️ WebUI構築完了: 起動から{profiler.elapsed():.2f}秒")
+    # gradioの読み込みまで含めた起動プロファイル（バックエンドの初期化は並行して続く場合がある）
+    profiler.report()
 
     # ポート競合時のエラーハンドリング
     max_retries = 5
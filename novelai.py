@@ -4,28 +4,58 @@ NovelAI-APIライブラリを使用してキャラクター座標対応画像を
 
 import os
 import asyncio
-from typing import Optional
-from dotenv import load_dotenv
-from PIL import Image
+from typing import TYPE_CHECKING, Optional
 import io
 
-try:
-    import aiohttp
-    from novelai_api import NovelAIAPI
-    from novelai_api.ImagePreset import ImageModel, ImagePreset
-except ImportError:
-    print("NovelAI-API または aiohttp がインストールされていません。")
-    print("pip install novelai-api aiohttp を実行してください。")
-    NovelAIAPI = None
+from cancellation import CancellationToken, RequestCancelledError, run_cancellable
 
-# 環境変数を読み込み
-load_dotenv()
+if TYPE_CHECKING:
+    from PIL import Image
+
+# NovelAI-API・aiohttpは初回利用時に読み込む（起動時間短縮のため）
+aiohttp = None
+NovelAIAPI = None
+ImageModel = None
+ImagePreset = None
+
+
+def _import_novelai_api() -> bool:
+    """NovelAI-API関連モジュールを読み込み、成功したらTrueを返す"""
+    global aiohttp, NovelAIAPI, ImageModel, ImagePreset
+    if NovelAIAPI is not None:
+        return True
+
+    try:
+        import aiohttp as _aiohttp
+        from novelai_api import NovelAIAPI as _NovelAIAPI
+        from novelai_api.ImagePreset import ImageModel as _ImageModel
+        from novelai_api.ImagePreset import ImagePreset as _ImagePreset
+    except ImportError:
+        print("NovelAI-API または aiohttp がインストールされていません。")
+        print("pip install novelai-api aiohttp を実行してください。")
+        return False
+
+    aiohttp = _aiohttp
+    ImageModel = _ImageModel
+    ImagePreset = _ImagePreset
+    NovelAIAPI = _NovelAIAPI
+    return True
+
+
+# 生成に使うプリセット（解像度・ステップ数・スケール）
+PRESET_SETTINGS = {
+    "model": "Anime_v45_Curated",
+    "width": 832,
+    "height": 1216,
+    "steps": 28,
+    "scale": 5.0,
+}
 
 
 class NovelAIGenerator:
     def __init__(self):
         """NovelAI画像生成器を初期化"""
-        if NovelAIAPI is None:
+        if not _import_novelai_api():
             raise ImportError("NovelAI-API ライブラリが見つかりません")
 
         self.username = os.getenv("NOVELAI_USERNAME")
@@ -35,10 +65,44 @@ class NovelAIGenerator:
                 "NOVELAI_USERNAME と NOVELAI_PASSWORD を .env に設定してください"
             )
 
+        # ログインで得たアクセストークン（リクエストごとの鍵導出・ログインを省略）
+        self._access_token = None
+
         print("NovelAI生成器を初期化完了")
 
+    async def _login(self, api):
+        """NovelAI APIにログイン（取得済みのアクセストークンがあれば再利用）"""
+        if self._access_token:
+            api.headers["Authorization"] = f"Bearer {self._access_token}"
+            print("NovelAI APIログイン（取得済みトークンを使用）")
+            return
+
+        print("NovelAI APIログイン中...")
+        access_token = await api.high_level.login(self.username, self.password)
+        if isinstance(access_token, str):
+            self._access_token = access_token
+        print("NovelAI APIログイン完了")
+
+    async def _prelogin_async(self):
+        async with aiohttp.ClientSession() as session:
+            await self._login(NovelAIAPI(session))
+
+    def prelogin(self) -> bool:
+        """起動時に事前ログインしてアクセストークンを取得（接続のウォームアップを兼ねる）"""
+        try:
+            asyncio.run(self._prelogin_async())
+            print("✓ NovelAI事前ログイン完了")
+            return True
+        except Exception as e:
+            print(f"NovelAI事前ログインエラー: {e}")
+            return False
+
     async def _generate_image_async(
-        self, prompt_data: dict, negative_prompt: str = "", **kwargs
+        self,
+        prompt_data: dict,
+        negative_prompt: str = "",
+        cancel_token: Optional[CancellationToken] = None,
+        **kwargs,
     ) -> Optional[bytes]:
         """
         NovelAI v4.5 キャラクター座標対応画像生成
@@ -106,19 +170,21 @@ class NovelAIGenerator:
             async with aiohttp.ClientSession() as session:
                 api = NovelAIAPI(session)
 
-                print("NovelAI APIログイン中...")
-                await api.high_level.login(self.username, self.password)
-                print("NovelAI APIログイン完了")
+                await self._login(api)
+
+                # ログイン中にキャンセルされていれば生成リクエストを送らない
+                if cancel_token:
+                    cancel_token.raise_if_cancelled("novelai")
 
                 print("画像生成開始... (832x1216)")
                 print("モデル: NovelAI v4.5c (Anime_v45_Curated)")
 
                 # プリセットを作成
                 preset = ImagePreset.from_default_config(model)
-                preset.width = 832
-                preset.height = 1216
-                preset.steps = 28
-                preset.scale = 5.0
+                preset.width = PRESET_SETTINGS["width"]
+                preset.height = PRESET_SETTINGS["height"]
+                preset.steps = PRESET_SETTINGS["steps"]
+                preset.scale = PRESET_SETTINGS["scale"]
                 preset.seed = kwargs.get("seed", 0)
                 preset.n_samples = 1
                 preset.uc = full_negative_prompt
@@ -145,16 +211,37 @@ class NovelAIGenerator:
                 print("画像生成に失敗しました")
                 return None
 
+        except RequestCancelledError:
+            raise
         except Exception as e:
             print(f"画像生成エラー: {e}")
+            # トークン失効の可能性があるため、次回は再ログインする
+            self._access_token = None
             return None
 
     def generate_image(
-        self, prompt_data: dict, negative_prompt: str = "", **kwargs
+        self,
+        prompt_data: dict,
+        negative_prompt: str = "",
+        cancel_token: Optional[CancellationToken] = None,
+        **kwargs,
     ) -> Optional[bytes]:
         """
         同期インターフェース - 内部で非同期処理を実行
+
+        cancel_tokenがキャンセルされると実行中のHTTPリクエストを中断し、
+        RequestCancelledErrorを送出する。
         """
+
+        def make_coro():
+            return run_cancellable(
+                self._generate_image_async(
+                    prompt_data, negative_prompt, cancel_token=cancel_token, **kwargs
+                ),
+                cancel_token,
+                "novelai",
+            )
+
         try:
             # イベントループの適切な処理
             try:
@@ -167,11 +254,7 @@ class NovelAIGenerator:
                     new_loop = asyncio.new_event_loop()
                     asyncio.set_event_loop(new_loop)
                     try:
-                        return new_loop.run_until_complete(
-                            self._generate_image_async(
-                                prompt_data, negative_prompt, **kwargs
-                            )
-                        )
+                        return new_loop.run_until_complete(make_coro())
                     finally:
                         new_loop.close()
 
@@ -182,10 +265,11 @@ class NovelAIGenerator:
             except RuntimeError:
                 # イベントループが存在しない場合は通常の方法で実行
                 print("新しいイベントループで実行中...")
-                return asyncio.run(
-                    self._generate_image_async(prompt_data, negative_prompt, **kwargs)
-                )
+                return asyncio.run(make_coro())
 
+        except RequestCancelledError:
+            print("画像生成をキャンセルしました")
+            raise
         except Exception as e:
             print(f"画像生成エラー: {e}")
             return None
@@ -201,9 +285,11 @@ class NovelAIGenerator:
             print(f"画像保存エラー: {e}")
             return False
 
-    def image_to_pil(self, image_data: bytes) -> Optional[Image.Image]:
+    def image_to_pil(self, image_data: bytes) -> Optional["Image.Image"]:
         """バイナリデータをPIL Imageに変換"""
         try:
+            from PIL import Image
+
             return Image.open(io.BytesIO(image_data))
         except Exception as e:
             print(f"PIL Image変換エラー: {e}")
@@ -249,4 +335,7 @@ def test_novelai():
 
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
     test_novelai()
@@ -0,0 +1,196 @@
+"""
+生成画像の後処理パイプライン（ProcessPoolExecutorで実行）
+
+リクエスト処理側は画像のバイト列をファイルに書き込み、そのパスだけを渡す。
+デコード・メタデータの除去/埋め込み・リサイズ・サムネイル作成・エンコードは
+別プロセスで行うため、PILのCPU処理がリクエスト処理とGILを取り合わない。
+"""
+
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# パイプラインで使えるステップ
+STEPS = ("strip_metadata", "embed_metadata", "resize", "thumbnail")
+FORMATS = {"png": "PNG", "webp": "WEBP", "jpeg": "JPEG", "jpg": "JPEG"}
+
+# 埋め込むメタデータのPNGテキストチャンク名
+METADATA_KEY = "naipgra"
+
+
+def load_config() -> dict:
+    """環境変数から後処理の設定を読み込む"""
+    steps = [
+        step.strip()
+        for step in os.getenv("IMAGE_POSTPROCESS", "").split(",")
+        if step.strip()
+    ]
+    unknown = [step for step in steps if step not in STEPS]
+    if unknown:
+        raise ValueError(f"未対応の後処理ステップです: {unknown}（利用可能: {STEPS}）")
+
+    output_format = os.getenv("IMAGE_OUTPUT_FORMAT", "png").lower()
+    if output_format not in FORMATS:
+        raise ValueError(f"未対応の出力形式です: {output_format}")
+
+    return {
+        "steps": steps,
+        "output_format": output_format,
+        "max_size": int(os.getenv("IMAGE_MAX_SIZE", 0)),
+        "thumbnail_size": int(os.getenv("IMAGE_THUMBNAIL_SIZE", 256)),
+        "quality": int(os.getenv("IMAGE_QUALITY", 90)),
+    }
+
+
+def thumbnail_path_for(path: str) -> str:
+    """画像に対応するサムネイルのパス（outputs/thumbnails/<名前>.webp）"""
+    directory, filename = os.path.split(path)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, "thumbnails", f"{stem}.webp")
+
+
+def _is_fresh(thumbnail_path: str, path: str) -> bool:
+    """サムネイルが作成済みで、元の画像より新しいか"""
+    return (
+        os.path.exists(thumbnail_path)
+        and os.path.getmtime(thumbnail_path) >= os.path.getmtime(path)
+    )
+
+
+def run_pipeline(path: str, config: dict, metadata: dict = None) -> dict:
+    """
+    画像ファイルに後処理を適用（子プロセスで実行される）
+
+    Args:
+        path (str): 保存済みの画像ファイル
+        config (dict): load_config()の設定
+        metadata (dict, optional): embed_metadataで埋め込む情報
+
+    Returns:
+        dict: path（後処理後の画像）, thumbnail_path, width, height,
+            metadata（画像に埋め込まれていた構造化プロンプト、ある場合のみ）
+    """
+    from PIL import Image, PngImagePlugin
+
+    steps = config["steps"]
+    image_format = FORMATS[config["output_format"]]
+    result = {"path": path, "thumbnail_path": None}
+
+    thumb_path = thumbnail_path_for(path)
+    make_thumbnail = "thumbnail" in steps and not _is_fresh(thumb_path, path)
+    resize = "resize" in steps and config["max_size"] > 0
+    # 再エンコードが不要なら元のファイルをそのまま使う
+    rewrite = (
+        image_format != "PNG"
+        or "strip_metadata" in steps
+        or "embed_metadata" in steps
+        or resize
+    )
+
+    with Image.open(path) as image:
+        original_info = dict(image.info)
+        # ヘッダーだけで済む場合は画素データをデコードしない
+        if make_thumbnail or rewrite:
+            image.load()
+
+    result["width"], result["height"] = image.size
+    # 埋め込み済みの構造化プロンプト（履歴の再構築で使用）
+    if METADATA_KEY in original_info:
+        try:
+            result["metadata"] = json.loads(original_info[METADATA_KEY])
+        except ValueError:
+            pass
+
+    if rewrite:
+        if resize:
+            image.thumbnail((config["max_size"], config["max_size"]))
+            result["width"], result["height"] = image.size
+
+        save_kwargs = {}
+        if image_format == "PNG":
+            pnginfo = PngImagePlugin.PngInfo()
+            if "strip_metadata" not in steps:
+                for key, value in original_info.items():
+                    if isinstance(value, str):
+                        pnginfo.add_text(key, value)
+            if "embed_metadata" in steps and metadata:
+                pnginfo.add_text(METADATA_KEY, json.dumps(metadata, ensure_ascii=False))
+            save_kwargs["pnginfo"] = pnginfo
+        else:
+            save_kwargs["quality"] = config["quality"]
+            if image_format == "JPEG":
+                image = image.convert("RGB")
+
+        output_path = os.path.splitext(path)[0] + "." + config["output_format"]
+        tmp_path = output_path + ".tmp"
+        image.save(tmp_path, image_format, **save_kwargs)
+        os.replace(tmp_path, output_path)
+        if output_path != path:
+            os.remove(path)
+        result["path"] = output_path
+
+    # サムネイルは書き換え後に作成する（元の画像より新しければ次回以降は再利用）
+    if "thumbnail" in steps:
+        if make_thumbnail:
+            thumbnail = image.copy()
+            size = config["thumbnail_size"]
+            thumbnail.thumbnail((size, size))
+            os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+            thumbnail.save(thumb_path, "WEBP", quality=80)
+        result["thumbnail_path"] = thumb_path
+
+    return result
+
+
+class ImagePostProcessor:
+    """後処理パイプラインをプロセスプールで実行する"""
+
+    def __init__(self, config: dict = None, workers: int = None):
+        self.config = config or load_config()
+        if workers is None:
+            workers = int(os.getenv("IMAGE_POSTPROCESS_WORKERS", 2))
+        # 0の場合はプロセスプールを使わず呼び出し元のスレッドで実行
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config["steps"]) or self.config["output_format"] != "png"
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # スレッドを持つプロセスからforkしないようにspawnで起動
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            return self._executor
+
+    def submit(self, path: str, metadata: dict = None) -> Future:
+        """後処理を投入（結果はrun_pipelineの戻り値）"""
+        if not self.enabled:
+            future = Future()
+            future.set_result({"path": path, "thumbnail_path": None})
+            return future
+        if self.workers <= 0:
+            future = Future()
+            try:
+                future.set_result(run_pipeline(path, self.config, metadata))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self._get_executor().submit(run_pipeline, path, self.config, metadata)
+
+    def process(self, path: str, metadata: dict = None) -> dict:
+        """後処理を実行して結果を待つ"""
+        return self.submit(path, metadata).result()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,246 @@
+"""
+前回の構造化プロンプトを差分で修正するモジュール
+
+「髪を赤にして」のような追加の要望は、前回のJSONに対するJSON Patch（RFC 6902）
+として扱う。髪・目の色の変更や位置の移動のような単純な修正はLLMを呼ばずに
+ローカルで差分を作成する。
+"""
+
+import copy
+import re
+from typing import Optional
+
+from routing import validate_prompt_data
+
+# 修正の要望とみなす文末表現（「してください」等の丁寧な語尾は除いて判定）
+REFINEMENT_SUFFIXES = (
+    "にして",
+    "に変えて",
+    "に変更",
+    "にする",
+    "消して",
+    "外して",
+    "追加して",
+    "足して",
+    "付けて",
+    "つけて",
+    "取って",
+    "増やして",
+    "減らして",
+    "移動して",
+    "移動させて",
+    "動かして",
+    "寄せて",
+    # 「長くして」「可愛くして」のような形容詞の連用形 + して
+    "くして",
+)
+# 新しいイラストの依頼を表す語（含む場合は修正とみなさない）
+NEW_REQUEST_WORDS = ("描いて", "描く", "書いて", "生成", "作って", "作成", "イラスト", "絵を", "画像を")
+_POLITE_SUFFIX_PATTERN = re.compile(r"(?:ください|下さい|くれ|ほしい|欲しい)?[。！!？?]*$")
+REFINEMENT_MAX_LENGTH = 40
+
+# 色の日本語表現 → Danbooruタグの接頭辞
+COLORS = {
+    "赤": "red",
+    "青": "blue",
+    "水色": "aqua",
+    "金": "blonde",
+    "金色": "blonde",
+    "黄": "yellow",
+    "黄色": "yellow",
+    "黒": "black",
+    "白": "white",
+    "銀": "silver",
+    "銀色": "silver",
+    "灰": "grey",
+    "灰色": "grey",
+    "茶": "brown",
+    "茶色": "brown",
+    "緑": "green",
+    "ピンク": "pink",
+    "紫": "purple",
+    "オレンジ": "orange",
+}
+_COLOR_PATTERN = "|".join(sorted(COLORS, key=len, reverse=True))
+_COLOR_TAGS = set(COLORS.values()) | {"light_brown", "light_blue", "dark_blue"}
+
+_HAIR_PATTERN = re.compile(rf"(?:髪|髪の毛)(?:の色)?を({_COLOR_PATTERN})(?:色|髪)?に")
+_EYES_PATTERN = re.compile(rf"(?:目|瞳)(?:の色)?を({_COLOR_PATTERN})(?:色)?に")
+_TARGET_PATTERN = re.compile(r"(?:キャラクター|キャラ)\s*(\d)|(\d)人目")
+_MOVE_VERBS = r"(?:移動させて|移動して|移動|動かして|寄せて|ずらして)"
+_GRID_PATTERN = re.compile(rf"([A-Ea-e])([1-5])(?:の位置)?(?:に|へ){_MOVE_VERBS}?")
+# 「上に」「下に」は「頭の上にリボン」のような位置関係にも使われるため、移動を表す動詞が続く場合のみ
+_DIRECTION_PATTERN = re.compile(rf"(左|右|中央|真ん中|上|下)(?:側|の方)?(?:に|へ){_MOVE_VERBS}")
+# 色・位置の指定を除いた残りとして許される語（助詞・語尾・句読点）
+_FILLER_PATTERN = re.compile(
+    r"(?:してください|して下さい|して|ください|下さい|変えて|変更|する|もっと|少し|ちょっと"
+    r"|の|を|は|に|へ|と|も|、|。|！|!|\s)*"
+)
+
+
+def looks_like_refinement(user_input: str) -> bool:
+    """前回のイラストに対する修正の要望らしいかを判定"""
+    text = _POLITE_SUFFIX_PATTERN.sub("", user_input.strip())
+    if not text or len(text) > REFINEMENT_MAX_LENGTH:
+        return False
+    if any(word in text for word in NEW_REQUEST_WORDS):
+        return False
+    return text.endswith(REFINEMENT_SUFFIXES)
+
+
+def _target_index(user_input: str, prompt_data: dict) -> Optional[int]:
+    """修正対象のキャラクター番号（0始まり）。特定できなければNone"""
+    characters = prompt_data.get("characterPrompts", [])
+    match = _TARGET_PATTERN.search(user_input)
+    if match:
+        index = int(match.group(1) or match.group(2)) - 1
+        return index if 0 <= index < len(characters) else None
+    return 0 if len(characters) == 1 else None
+
+
+def _swap_color_tag(prompt: str, suffix: str, color: str) -> str:
+    """プロンプト内の「色_suffix」タグを差し替え（なければ追加）"""
+    tags = [tag.strip() for tag in prompt.split(",") if tag.strip()]
+    new_tag = f"{color}_{suffix}"
+    for i, tag in enumerate(tags):
+        if tag.endswith(f"_{suffix}") and tag[: -len(suffix) - 1] in _COLOR_TAGS:
+            tags[i] = new_tag
+            break
+    else:
+        tags.append(new_tag)
+    return ", ".join(tags)
+
+
+def _move_position(position: Optional[str], match: re.Match) -> str:
+    """座標指定・方向指定の照合結果から新しい座標を求める"""
+    if match.re is _GRID_PATTERN:
+        return f"{match.group(1).upper()}{match.group(2)}"
+
+    # A1=左上、E5=右下。位置指定がなかったキャラクターは中央から動かす
+    column, row = (position or "C3")[0], (position or "C3")[1]
+    word = match.group(1)
+    if word == "左":
+        column = "B"
+    elif word == "右":
+        column = "D"
+    elif word in ("中央", "真ん中"):
+        column, row = "C", "3"
+    elif word == "上":
+        row = "2"
+    elif word == "下":
+        row = "4"
+    return f"{column}{row}"
+
+
+def _covers_instruction(user_input: str, matches: list) -> bool:
+    """照合した語を除いた指示の残りが、助詞・語尾だけであるか"""
+    rest = user_input
+    for match in sorted(matches, key=lambda m: m.start(), reverse=True):
+        rest = rest[: match.start()] + " " + rest[match.end() :]
+    return _FILLER_PATTERN.fullmatch(rest) is not None
+
+
+def local_edit_patch(prompt_data: dict, user_input: str) -> Optional[list]:
+    """
+    LLMを使わずに処理できる修正であればJSON Patchを作成
+
+    髪・目の色の変更と位置の移動だけで指示全体が説明できる場合に限る
+    （「髪を赤にして、背景を夜にして」のように他の要望を含む場合はLLMに任せる）。
+
+    Returns:
+        list: JSON Patchの操作リスト（ローカルで処理できない場合はNone）
+    """
+    index = _target_index(user_input, prompt_data)
+    if index is None:
+        return None
+
+    hair = _HAIR_PATTERN.search(user_input)
+    eyes = _EYES_PATTERN.search(user_input)
+    move = _GRID_PATTERN.search(user_input) or _DIRECTION_PATTERN.search(user_input)
+    if not (hair or eyes or move):
+        return None
+    matches = [m for m in (_TARGET_PATTERN.search(user_input), hair, eyes, move) if m]
+    if not _covers_instruction(user_input, matches):
+        return None
+
+    character = prompt_data["characterPrompts"][index]
+    base_path = f"/characterPrompts/{index}"
+    prompt = character.get("prompt", "")
+    operations = []
+
+    if hair:
+        prompt = _swap_color_tag(prompt, "hair", COLORS[hair.group(1)])
+    if eyes:
+        color = COLORS[eyes.group(1)]
+        prompt = _swap_color_tag(prompt, "eyes", "yellow" if color == "blonde" else color)
+    if prompt != character.get("prompt", ""):
+        operations.append({"op": "replace", "path": f"{base_path}/prompt", "value": prompt})
+
+    if move:
+        position = _move_position(character.get("position"), move)
+        op = "replace" if "position" in character else "add"
+        operations.append({"op": op, "path": f"{base_path}/position", "value": position})
+
+    return operations or None
+
+
+def _parse_pointer(path: str) -> list:
+    if not path.startswith("/"):
+        raise ValueError(f"不正なパスです: {path}")
+    return [part.replace("~1", "/").replace("~0", "~") for part in path[1:].split("/")]
+
+
+def _resolve_parent(document, parts: list):
+    target = document
+    for part in parts[:-1]:
+        target = target[int(part)] if isinstance(target, list) else target[part]
+    return target, parts[-1]
+
+
+def apply_json_patch(document: dict, operations: list) -> dict:
+    """
+    JSON Patch（add / remove / replace）を適用した新しいドキュメントを返す
+
+    Raises:
+        ValueError: 未対応の操作や不正なパスが含まれる場合、適用結果が構造化プロンプトとして不正な場合
+    """
+    if not isinstance(operations, list):
+        raise ValueError(f"パッチは操作のリストである必要があります: {operations!r}")
+    result = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict):
+            raise ValueError(f"不正なパッチ操作です: {operation!r}")
+        op = operation.get("op")
+        try:
+            parent, key = _resolve_parent(result, _parse_pointer(operation.get("path", "")))
+            if isinstance(parent, list):
+                index = len(parent) if key == "-" else int(key)
+                if op == "add":
+                    parent.insert(index, operation["value"])
+                elif op == "replace":
+                    parent[index] = operation["value"]
+                elif op == "remove":
+                    del parent[index]
+                else:
+                    raise ValueError(f"未対応の操作です: {op}")
+            else:
+                if op in ("add", "replace"):
+                    if op == "replace" and key not in parent:
+                        raise ValueError(f"存在しないキーです: {operation['path']}")
+                    parent[key] = operation["value"]
+                elif op == "remove":
+                    del parent[key]
+                else:
+                    raise ValueError(f"未対応の操作です: {op}")
+        except (IndexError, KeyError, TypeError) as e:
+            raise ValueError(f"パッチの適用に失敗しました: {operation} ({e})")
+
+    # キャラクターの追加・削除に合わせてキャラクター数を更新
+    characters = result.get("characterPrompts")
+    if not isinstance(characters, list) or not characters:
+        raise ValueError("characterPromptsが空になりました")
+    result["characterCount"] = len(characters)
+    # 位置の書式やプロンプトの型が崩れたパッチは、新しい依頼としての処理に任せる
+    if not validate_prompt_data(result):
+        raise ValueError(f"パッチ適用後のプロンプトが不正です: {operations}")
+    return result
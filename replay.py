@@ -0,0 +1,423 @@
+"""
+実際のリクエストの記録と再生
+
+REPLAY_RECORD_PATH を設定すると、IllustrationChatServiceが処理したリクエストを
+1件1行のJSON（追記のみ）で記録する。記録するのは到着時刻・入力・構造化プロンプト・
+プリセット・seed・段階ごとの所要時間・応答サイズで、画像のバイト列は含めない。
+APIキー等の秘密情報は書き込む前に伏せ字にする。
+
+記録したワークロードは、ChatGPT・NovelAIを記録された所要時間だけ待つスタブに
+差し替えたパイプラインに対して、同じ到着間隔（または加速して）で再投入できる。
+
+使い方:
+    python replay.py replay.jsonl --speed 10
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Optional
+
+from cancellation import CancellationToken, RequestCancelledError
+from routing import ModelRouter
+
+REDACTED = "[REDACTED]"
+
+# 記録から伏せる秘密情報（値そのものは環境変数から取得）
+SECRET_ENV_VARS = ("OPENAI_API_KEY", "NOVELAI_USERNAME", "NOVELAI_PASSWORD")
+_SECRET_PATTERNS = (
+    re.compile(r"sk-[A-Za-z0-9_\-]{16,}"),
+    re.compile(r"pst-[A-Za-z0-9_\-]{16,}"),
+    re.compile(r"(?i)bearer\s+[A-Za-z0-9._\-]+"),
+    re.compile(r"eyJ[A-Za-z0-9_\-]{10,}\.[A-Za-z0-9_\-]{10,}\.[A-Za-z0-9_\-]+"),
+)
+
+
+def redact(value, secrets: tuple = ()):
+    """文字列（dict・listの中身も含む）から秘密情報を伏せ字にする"""
+    if isinstance(value, str):
+        for secret in secrets:
+            value = value.replace(secret, REDACTED)
+        for pattern in _SECRET_PATTERNS:
+            value = pattern.sub(REDACTED, value)
+        return value
+    if isinstance(value, dict):
+        return {key: redact(item, secrets) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item, secrets) for item in value]
+    return value
+
+
+class RequestRecord:
+    """1リクエスト分の記録（段階ごとの所要時間を積算）"""
+
+    def __init__(self, kind: str, user_input: str, session_id: str):
+        self.data = {
+            "t": round(time.time(), 3),
+            "kind": kind,
+            # セッションは同一性だけが分かればよいのでハッシュ化
+            "session": hashlib.sha1(session_id.encode("utf-8")).hexdigest()[:8],
+            "input": user_input,
+            "stages": {},
+            "images": [],
+        }
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            stages = self.data["stages"]
+            stages[name] = round(stages.get(name, 0.0) + seconds, 3)
+
+    def add_image(
+        self, prompt_data: dict, seed: int, wait: float, seconds: float, size: int
+    ):
+        """NovelAIへの1回の生成（バリエーションでは複数回）を記録"""
+        with self._lock:
+            self.data["images"].append(
+                {
+                    "prompt_data": prompt_data,
+                    "seed": seed,
+                    "wait": round(wait, 3),
+                    "novelai": round(seconds, 3),
+                    "bytes": size,
+                }
+            )
+
+    def set_prompt(self, prompt_data: dict, preset: dict):
+        """構造化プロンプトとNovelAIのプリセットを記録"""
+        with self._lock:
+            self.data["prompt_data"] = prompt_data
+            self.data["preset"] = preset
+            self.data["prompt_bytes"] = len(
+                json.dumps(prompt_data, ensure_ascii=False).encode("utf-8")
+            )
+
+    def set(self, **fields):
+        with self._lock:
+            self.data.update(fields)
+
+
+class ReplayRecorder:
+    """リクエストの記録をJSON Lines形式で追記する"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._secrets = tuple(
+            value
+            for value in (os.getenv(name, "") for name in SECRET_ENV_VARS)
+            if len(value) >= 4
+        )
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    @classmethod
+    def from_env(cls) -> Optional["ReplayRecorder"]:
+        """REPLAY_RECORD_PATHが設定されている場合のみ記録する"""
+        path = os.getenv("REPLAY_RECORD_PATH")
+        if not path:
+            return None
+        print(f"📼 リクエストを記録します: {path}")
+        return cls(path)
+
+    def write(self, record: RequestRecord, status: str):
+        entry = redact(dict(record.data, status=status), self._secrets)
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+
+def load_records(path: str) -> list:
+    """記録を到着時刻順に読み込む（書き込み途中の行は無視）"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    records.sort(key=lambda record: record["t"])
+    return records
+
+
+def _prompt_key(prompt_data: dict) -> str:
+    return json.dumps(prompt_data, ensure_ascii=False, sort_keys=True)
+
+
+def placeholder_png(width: int = 832, height: int = 1216) -> bytes:
+    """後処理でデコードできるダミー画像（圧縮の効かないノイズで実画像に近いサイズにする）"""
+    rng = random.Random(0)
+    raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        body = kind + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(raw, 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _sleep(seconds: float, token: Optional[CancellationToken], stage: str):
+    """記録された時間だけ待つ（キャンセルされたら中断）"""
+    if token is None:
+        time.sleep(seconds)
+        return
+    if token.wait(seconds):
+        raise RequestCancelledError(stage, token.reason)
+
+
+class StubChatGPT:
+    """記録された構造化プロンプトを、記録された所要時間の後に返すChatGPTの代替"""
+
+    def __init__(self, records: list, latency_scale: float = 1.0):
+        self.router = ModelRouter()
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._by_input = defaultdict(deque)
+        for record in records:
+            # 再生成はChatGPTを呼ばない
+            if record.get("kind") != "regenerate":
+                self._by_input[record["input"]].append(record)
+
+    def _next(self, user_input: str) -> Optional[dict]:
+        with self._lock:
+            queue = self._by_input.get(user_input)
+            return queue.popleft() if queue else None
+
+    def _wait(self, user_input: str, record: dict, cancel_token):
+        # 記録した入力に対するルーティングの判定を集計する（所要時間は記録の値）
+        tier = self.router.route(user_input)
+        seconds = record.get("stages", {}).get("chatgpt", 0.0) * self.latency_scale
+        _sleep(seconds, cancel_token, "chatgpt")
+        self.router.record_latency(tier, seconds)
+
+    def enhance_illustration_prompt(self, user_input, cancel_token=None):
+        record = self._next(user_input) or {}
+        self._wait(user_input, record, cancel_token)
+        return record.get("prompt_data") or {
+            "characterCount": 1,
+            "prompt": "masterpiece, best_quality",
+            "characterPrompts": [{"prompt": user_input}],
+        }
+
+    def enhance_illustration_variations(self, user_input, count, cancel_token=None):
+        record = self._next(user_input) or {}
+        self._wait(user_input, record, cancel_token)
+        variations = [image["prompt_data"] for image in record.get("images", [])]
+        return variations[:count] or [self.enhance_illustration_prompt(user_input)]
+
+    def refine_prompt(self, prompt_data, instruction, cancel_token=None):
+        # 記録には最終的な構造化プロンプトがあるため、差分は作らず新規扱いにさせる
+        return None
+
+
+class StubNovelAI:
+    """記録された所要時間の後にダミー画像を返すNovelAIの代替"""
+
+    def __init__(self, records: list, latency_scale: float = 1.0):
+        self.latency_scale = latency_scale
+        self._lock = threading.Lock()
+        self._by_prompt = defaultdict(deque)
+        latencies = []
+        for record in records:
+            for image in record.get("images", []):
+                self._by_prompt[_prompt_key(image["prompt_data"])].append(image["novelai"])
+                latencies.append(image["novelai"])
+            # ジョブキューモードの記録はワーカーでの処理時間全体を生成時間とみなす
+            if not record.get("images") and "job" in record.get("stages", {}):
+                if record.get("prompt_data"):
+                    key = _prompt_key(record["prompt_data"])
+                    self._by_prompt[key].append(record["stages"]["job"])
+        # 記録と対応しない生成（フォールバック等）は中央値で待つ
+        latencies.sort()
+        self._default_latency = latencies[len(latencies) // 2] if latencies else 0.0
+        self._image = placeholder_png()
+
+    def generate_image(self, prompt_data, negative_prompt="", cancel_token=None, **kwargs):
+        with self._lock:
+            queue = self._by_prompt.get(_prompt_key(prompt_data))
+            seconds = queue.popleft() if queue else self._default_latency
+        _sleep(seconds * self.latency_scale, cancel_token, "novelai")
+        return self._image
+
+    def image_to_pil(self, image_data):
+        return None
+
+
+class Replayer:
+    """記録されたワークロードを到着間隔どおりにサービスへ再投入する"""
+
+    def __init__(self, records: list, speed: float = 1.0, latency_scale: float = 1.0):
+        from main import IllustrationChatService
+
+        self.records = records
+        self.speed = speed
+        self.latency_scale = latency_scale
+        self.service = IllustrationChatService(
+            use_job_queue=False,
+            backends=(
+                StubChatGPT(records, latency_scale),
+                StubNovelAI(records, latency_scale),
+            ),
+        )
+        self.results = []
+        self._lock = threading.Lock()
+
+    def _issue(self, index: int, record: dict):
+        # セッションごとの上書きキャンセルも再現されるよう、記録のセッションを使う
+        session_id = record.get("session", str(index))
+        kind = record.get("kind", "generate")
+        start = time.perf_counter()
+
+        # クリア・切断でキャンセルされたリクエストは、記録と同じ経過時間でキャンセルする
+        # （同一セッションの新規リクエストによる置き換えは再投入するだけで再現される）
+        timer = None
+        if record.get("status") == "cancelled" and record.get("cancel_reason") != "superseded":
+            timer = threading.Timer(
+                record.get("duration", 0.0) * self.latency_scale,
+                self.service.cancel_session,
+                args=(session_id, record.get("cancel_reason") or "cancelled"),
+            )
+            timer.start()
+
+        history = []
+        if kind == "regenerate":
+            # 共有の状態を経由せず、記録されたプロンプトをそのまま渡す
+            updates = self.service.regenerate_image(
+                history,
+                session_id,
+                prompt_data=record.get("prompt_data"),
+                user_input=record.get("input"),
+            )
+        elif kind == "variations":
+            count = len(record.get("images", [])) or None
+            updates = self.service.generate_variations(
+                record["input"], history, session_id, count=count
+            )
+        else:
+            updates = self.service.process_user_request(
+                record["input"], history, session_id
+            )
+        for _ in updates:
+            pass
+        if timer is not None:
+            timer.cancel()
+
+        with self._lock:
+            self.results.append(
+                {
+                    "kind": kind,
+                    "seconds": time.perf_counter() - start,
+                    "recorded_seconds": record.get("duration", 0.0),
+                    "recorded_status": record.get("status"),
+                    "message": history[-1]["content"].strip().splitlines()[0] if history else "",
+                }
+            )
+
+    def run(self) -> dict:
+        if not self.records:
+            print("⚠️ 記録がありません")
+            return {}
+        print(f"▶️ {len(self.records)}件を{self.speed}倍速で再生します")
+        origin = self.records[0]["t"]
+        started = time.perf_counter()
+        threads = []
+        for i, record in enumerate(self.records):
+            delay = (record["t"] - origin) / self.speed - (time.perf_counter() - started)
+            if delay > 0:
+                time.sleep(delay)
+            thread = threading.Thread(target=self._issue, args=(i, record), daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return self.report(time.perf_counter() - started)
+
+    def report(self, elapsed: float) -> dict:
+        def percentile(values: list, p: float) -> float:
+            if not values:
+                return 0.0
+            values = sorted(values)
+            return round(values[min(len(values) - 1, int(len(values) * p))], 3)
+
+        latencies = [result["seconds"] for result in self.results]
+        recorded = [result["recorded_seconds"] for result in self.results]
+        by_outcome = defaultdict(int)
+        for result in self.results:
+            by_outcome[result["message"][:20]] += 1
+        report = {
+            "requests": len(self.results),
+            "elapsed_seconds": round(elapsed, 3),
+            "latency_p50": percentile(latencies, 0.5),
+            "latency_p95": percentile(latencies, 0.95),
+            "recorded_latency_p50": percentile(recorded, 0.5),
+            "recorded_latency_p95": percentile(recorded, 0.95),
+            "outcomes": dict(by_outcome),
+            "cancellations": self.service.get_cancellation_stats(),
+            "routing": self.service.get_routing_stats(),
+        }
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="記録したリクエストをスタブのバックエンドで再生")
+    parser.add_argument("record", help="REPLAY_RECORD_PATHで記録したファイル")
+    parser.add_argument("--speed", type=float, default=1.0, help="到着間隔を何倍速で再生するか")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="記録されたChatGPT・NovelAIの所要時間に掛ける係数",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="画像・履歴の出力先（省略時は一時ディレクトリ）",
+    )
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    records = load_records(os.path.abspath(args.record))
+
+    # 再生中は記録しない・本番のoutputsや履歴を汚さない
+    os.environ.pop("REPLAY_RECORD_PATH", None)
+    os.environ["JOB_QUEUE_ENABLED"] = "false"
+    # 記録済みの最終的なプロンプトを使うため、ローカルでの差分修正は行わない
+    os.environ["REFINEMENT_ENABLED"] = "false"
+    workdir = args.workdir or tempfile.mkdtemp(prefix="naipgra-replay-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"📁 出力先: {workdir}")
+
+    Replayer(records, args.speed, args.latency_scale).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+入力の複雑さに応じて高速モデルと通常モデルを切り替えるルーター
+"""
+
+import os
+import re
+import threading
+
+FAST = "fast"
+FULL = "full"
+
+# キャラクターを表す語（人数の推定に使用）
+_CHARACTER_WORDS = (
+    "女の子",
+    "男の子",
+    "少女",
+    "少年",
+    "女性",
+    "男性",
+    "お姉さん",
+    "お兄さん",
+    "おじさん",
+    "おばさん",
+    "子供",
+    "魔法使い",
+    "騎士",
+    "メイド",
+    "先生",
+    "生徒",
+    "女子高生",
+    "男子高校生",
+    "牧師",
+)
+_CHARACTER_PATTERN = re.compile("|".join(map(re.escape, _CHARACTER_WORDS)))
+_KANJI_NUMBERS = {"一": 1, "二": 2, "三": 3, "四": 4, "五": 5, "六": 6}
+_COUNT_PATTERN = re.compile(r"([1-6一二三四五六])\s*人")
+
+# 位置関係を表す語
+_POSITIONAL_WORDS = (
+    "左",
+    "右",
+    "隣",
+    "後ろ",
+    "背後",
+    "手前",
+    "奥",
+    "中央",
+    "真ん中",
+    "向かい合",
+    "並んで",
+    "間に",
+    "上に",
+    "下に",
+)
+_POSITIONAL_PATTERN = re.compile("|".join(map(re.escape, _POSITIONAL_WORDS)))
+_GRID_PATTERN = re.compile(r"(?<![A-Za-z0-9])[A-Ea-e][1-5](?![0-9])")
+
+
+def score_complexity(user_input: str) -> dict:
+    """
+    入力の複雑さをローカルで採点
+
+    Returns:
+        dict: score（合計点）と内訳（length, characters, positional）
+    """
+    text = user_input.strip()
+
+    count_match = _COUNT_PATTERN.search(text)
+    if count_match:
+        value = count_match.group(1)
+        characters = _KANJI_NUMBERS.get(value) or int(value)
+    else:
+        characters = max(1, len(_CHARACTER_PATTERN.findall(text)))
+
+    positional = len(_POSITIONAL_PATTERN.findall(text)) + len(_GRID_PATTERN.findall(text))
+
+    # 文字数は30文字ごとに1点、キャラクターは2人目以降1人につき2点、位置関係は1語につき2点
+    score = len(text) // 30 + (characters - 1) * 2 + positional * 2
+    return {
+        "score": score,
+        "length": len(text),
+        "characters": characters,
+        "positional": positional,
+    }
+
+
+class ModelRouter:
+    """採点結果から使用するモデルの階層を決め、判定とレイテンシを記録する"""
+
+    def __init__(self, threshold: int = None, fast_available: bool = True):
+        if threshold is None:
+            threshold = int(os.getenv("LLM_ROUTER_THRESHOLD", 2))
+        self.threshold = threshold
+        # 高速モデルが設定されていない場合は、全て通常モデルとして判定・記録する
+        self.fast_available = fast_available
+        # この件数の判定ごとに集計をログに出す（0以下で無効）
+        self.log_every = int(os.getenv("LLM_ROUTER_LOG_EVERY", 50))
+        self._lock = threading.Lock()
+        self.decisions = {FAST: 0, FULL: 0}
+        self.escalations = 0
+        self.latency = {FAST: [0, 0.0], FULL: [0, 0.0]}  # [呼び出し回数, 合計秒数]
+
+    def route(self, user_input: str) -> str:
+        """入力に対するモデルの階層（fast / full）を返す"""
+        complexity = score_complexity(user_input)
+        tier = FAST if self.fast_available and complexity["score"] < self.threshold else FULL
+        self.record_decision(tier)
+        print(f"🧭 LLMルーティング: {tier} (複雑さ: {complexity})")
+        return tier
+
+    def record_decision(self, tier: str):
+        """採点を経ずに階層を決めた呼び出しも判定件数に数える"""
+        with self._lock:
+            self.decisions[tier] += 1
+            total = sum(self.decisions.values())
+        if self.log_every > 0 and total % self.log_every == 0:
+            print(f"📊 LLMルーティング集計: {self.snapshot()}")
+
+    def record_latency(self, tier: str, seconds: float):
+        with self._lock:
+            self.latency[tier][0] += 1
+            self.latency[tier][1] += seconds
+
+    def record_escalation(self):
+        with self._lock:
+            self.escalations += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "threshold": self.threshold,
+                "fast_available": self.fast_available,
+                "decisions": dict(self.decisions),
+                "escalations": self.escalations,
+                "average_latency_seconds": {
+                    tier: round(total / count, 3) if count else None
+                    for tier, (count, total) in self.latency.items()
+                },
+            }
+
+
+def validate_prompt_data(prompt_data) -> bool:
+    """ChatGPTが返した構造化プロンプトが想定の形式か検証"""
+    if not isinstance(prompt_data, dict):
+        return False
+    if not isinstance(prompt_data.get("prompt"), str):
+        return False
+    characters = prompt_data.get("characterPrompts")
+    if not isinstance(characters, list) or not 1 <= len(characters) <= 6:
+        return False
+    for character in characters:
+        if not isinstance(character, dict) or not isinstance(character.get("prompt"), str):
+            return False
+        position = character.get("position")
+        if position is not None and not re.fullmatch(r"[A-E][1-5]", str(position)):
+            return False
+    return True
+
+
+def validate_variations(parsed) -> bool:
+    """バリエーション生成の返答（{"variations": [構造化プロンプト, ...]}）を検証"""
+    if not isinstance(parsed, dict):
+        return False
+    variations = parsed.get("variations")
+    return (
+        isinstance(variations, list)
+        and len(variations) > 0
+        and all(validate_prompt_data(variation) for variation in variations)
+    )
@@ -0,0 +1,62 @@
+"""
+起動時間の計測（インポート時間・バックエンド初期化時間のプロファイル）
+"""
+
+import importlib
+import threading
+import time
+from contextlib import contextmanager
+
+# プロセス起動からの基準時刻
+_PROCESS_START = time.perf_counter()
+
+
+class StartupProfiler:
+    """起動処理の各段階の所要時間を記録"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    @contextmanager
+    def measure(self, name: str):
+        """withブロックの所要時間を記録"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.records.append((name, elapsed, threading.current_thread().name))
+
+    def import_module(self, name: str):
+        """モジュールをインポートし、インポート時間を記録"""
+        with self.measure(f"import {name}"):
+            return importlib.import_module(name)
+
+    def elapsed(self) -> float:
+        """プロセス起動からの経過秒数"""
+        return time.perf_counter() - _PROCESS_START
+
+    def report(self) -> dict:
+        """計測結果を表示して辞書で返す"""
+        with self._lock:
+            records = list(self.records)
+
+        print("⏱️ 起動プロファイル:")
+        for name, elapsed, thread_name in records:
+            print(f"   {name}: {elapsed * 1000:.1f}ms ({thread_name})")
+        total = self.elapsed()
+        print(f"   起動開始からの経過: {total * 1000:.1f}ms")
+
+        return {
+            "records": [
+                {"name": name, "seconds": elapsed, "thread": thread_name}
+                for name, elapsed, thread_name in records
+            ],
+            "total_seconds": total,
+        }
+
+
+# アプリ全体で共有するプロファイラー
+profiler = StartupProfiler()
@@ -0,0 +1,114 @@
+"""batch.py（入力の読み込み・マニフェストからの再開）のテスト"""
+
+import json
+
+import pytest
+
+from batch import MANIFEST_NAME, BatchRunner, load_completed_ids, load_items
+
+PROMPT_DATA = {
+    "characterCount": 1,
+    "prompt": "masterpiece, library",
+    "characterPrompts": [{"prompt": "1girl, reading"}],
+}
+
+
+def _write_lines(path, lines):
+    path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+    return str(path)
+
+
+class _StubNovelAI:
+    def __init__(self):
+        self.prompts = []
+
+    def generate_image(self, prompt_data, cancel_token=None, **kwargs):
+        self.prompts.append(prompt_data["prompt"])
+        return b"png"
+
+
+def test_load_items_assigns_ids(tmp_path):
+    path = _write_lines(
+        tmp_path / "items.jsonl",
+        [
+            json.dumps({"id": "cat/01", "input": "猫の女の子"}, ensure_ascii=False),
+            "",
+            json.dumps({"prompt_data": PROMPT_DATA}),
+        ],
+    )
+    items = load_items(path)
+    assert len(items) == 2
+    # ファイル名として使うため、パス区切りは置き換える
+    assert items[0]["id"] == "cat_01"
+    assert items[1]["id"]
+
+
+def test_generated_ids_do_not_depend_on_line_order(tmp_path):
+    lines = [json.dumps({"input": "猫"}), json.dumps({"input": "犬"})]
+    forward = load_items(_write_lines(tmp_path / "a.jsonl", lines))
+    backward = load_items(_write_lines(tmp_path / "b.jsonl", lines[::-1]))
+    assert {item["id"] for item in forward} == {item["id"] for item in backward}
+
+
+@pytest.mark.parametrize(
+    "lines",
+    [
+        # 明示的なIDの重複（大文字・小文字のみの違いを含む）
+        ['{"id": "a", "input": "猫"}', '{"id": "a", "input": "犬"}'],
+        ['{"id": "Cat", "input": "猫"}', '{"id": "cat", "input": "犬"}'],
+        # 置き換え後に同じIDになる
+        ['{"id": "a/b", "input": "猫"}', '{"id": "a_b", "input": "犬"}'],
+        # 同じ内容の行（内容から生成したIDが重複）
+        ['{"input": "猫"}', '{"input": "猫"}'],
+    ],
+)
+def test_duplicate_ids_are_rejected(tmp_path, lines):
+    with pytest.raises(ValueError, match=r":2 ID"):
+        load_items(_write_lines(tmp_path / "items.jsonl", lines))
+
+
+@pytest.mark.parametrize("line", ["42", "[1, 2]", '"猫の女の子"', "null", '{"id": "x"}', "{broken"])
+def test_invalid_lines_report_line_number(tmp_path, line):
+    path = _write_lines(tmp_path / "items.jsonl", ['{"input": "猫"}', line])
+    with pytest.raises(ValueError, match=r"items\.jsonl:2 "):
+        load_items(path)
+
+
+def test_load_completed_ids_skips_errors_and_broken_lines(tmp_path):
+    manifest = tmp_path / MANIFEST_NAME
+    manifest.write_text(
+        "\n".join(
+            [
+                json.dumps({"id": "a", "status": "ok"}),
+                json.dumps({"id": "b", "status": "error", "error": "timeout"}),
+                "[1, 2]",
+                # 書き込み途中で中断された最終行
+                '{"id": "c", "sta',
+            ]
+        ),
+        encoding="utf-8",
+    )
+    assert load_completed_ids(str(manifest)) == {"a"}
+    assert load_completed_ids(str(tmp_path / "missing.jsonl")) == set()
+
+
+def test_run_resumes_from_manifest(tmp_path):
+    items = [
+        {"id": name, "prompt_data": {**PROMPT_DATA, "prompt": name}} for name in ("a", "b", "c")
+    ]
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    (output_dir / MANIFEST_NAME).write_text(
+        json.dumps({"id": "a", "status": "ok"}) + "\n"
+        + json.dumps({"id": "b", "status": "error"}) + "\n",
+        encoding="utf-8",
+    )
+
+    novelai = _StubNovelAI()
+    result = BatchRunner(str(output_dir), novelai=novelai).run(items)
+
+    # 成功済みの項目だけをスキップし、失敗した項目は再実行する
+    assert sorted(novelai.prompts) == ["b", "c"]
+    assert result["ok"] == 2
+    assert load_completed_ids(str(output_dir / MANIFEST_NAME)) == {"a", "b", "c"}
+    assert (output_dir / "c.png").read_bytes() == b"png"
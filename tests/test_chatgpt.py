@@ -0,0 +1,43 @@
+"""chatGPT.py（ChatGPTProcessor）のテスト（APIは呼ばずにクライアントを差し替える）"""
+
+import threading
+from types import SimpleNamespace
+
+from chatGPT import ChatGPTProcessor
+
+
+class _Paginator:
+    """openai-pythonのAsyncPaginatorと同様に、コルーチンではないがawait可能なオブジェクト"""
+
+    def __init__(self, calls):
+        self._calls = calls
+
+    def __await__(self):
+        self._calls.append("list")
+        if False:
+            yield
+        return []
+
+
+def _processor(list_models):
+    processor = ChatGPTProcessor.__new__(ChatGPTProcessor)
+    processor.llm = SimpleNamespace(
+        root_async_client=SimpleNamespace(models=SimpleNamespace(list=list_models))
+    )
+    processor._loop = None
+    processor._loop_lock = threading.Lock()
+    return processor
+
+
+def test_warm_up_awaits_non_coroutine_paginator():
+    calls = []
+    processor = _processor(lambda: _Paginator(calls))
+    assert processor.warm_up() is True
+    assert calls == ["list"]
+
+
+def test_warm_up_reports_failure():
+    def list_models():
+        raise ConnectionError("unreachable")
+
+    assert _processor(list_models).warm_up() is False
@@ -0,0 +1,130 @@
+"""history_index.py（生成履歴の索引・検索）のテスト"""
+
+import sqlite3
+
+import pytest
+
+from history_index import HistoryIndex, parse_query
+
+INPUTS = [
+    "猫の女の子が花畑で笑っている",
+    "金髪の魔法使い",
+    "猫と犬が公園で遊んでいる",
+    "夜の図書館で本を読む少女",
+    "金魚すくいをする浴衣の女の子",
+]
+
+
+@pytest.fixture
+def index(tmp_path):
+    return HistoryIndex(str(tmp_path / "history.sqlite3"))
+
+
+def _add_all(index, inputs=INPUTS, created_at=1000.0):
+    return [
+        index.add(
+            f"outputs/{i}.png",
+            user_input=user_input,
+            prompt_data={"prompt": "1girl, solo" if i % 2 == 0 else "1girl, night"},
+            created_at=created_at + i,
+        )
+        for i, user_input in enumerate(inputs)
+    ]
+
+
+def _paths(entries):
+    return [entry["path"] for entry in entries]
+
+
+def test_keyset_pages_cover_every_entry_once(index):
+    # 同じ秒に保存された画像（created_atが同じ）もidで順序が決まる
+    for i in range(7):
+        index.add(f"outputs/{i}.png", user_input="猫", created_at=1000.0 + i // 3)
+
+    seen = []
+    cursor = None
+    pages = 0
+    while True:
+        entries, cursor = index.search(text="猫", cursor=cursor, page_size=3)
+        seen += _paths(entries)
+        pages += 1
+        if cursor is None:
+            break
+
+    assert pages == 3
+    assert len(seen) == len(set(seen)) == 7
+    # 新しい順（同じ時刻なら後から登録したもの）
+    assert seen == [f"outputs/{i}.png" for i in (6, 5, 4, 3, 2, 1, 0)]
+
+
+def test_last_full_page_has_no_cursor(index):
+    _add_all(index)
+    entries, cursor = index.search(page_size=5)
+    assert len(entries) == 5
+    assert cursor is None
+
+
+def test_page_is_stable_when_new_images_are_added(index):
+    _add_all(index)
+    first, cursor = index.search(page_size=2)
+    index.add("outputs/new.png", user_input="新しい画像", created_at=2000.0)
+    second, _ = index.search(cursor=cursor, page_size=2)
+    assert not set(_paths(first)) & set(_paths(second))
+    assert "outputs/new.png" not in _paths(second)
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        ("猫", [2, 0]),
+        ("金", [4, 1]),
+        ("金髪", [1]),
+        ("女の子", [4, 0]),
+        ("図書館", [3]),
+        # 空白区切りはAND（1〜2文字と3文字以上の語の組み合わせを含む）
+        ("猫 公園", [2]),
+        ("女の子 猫", [0]),
+        ("犬 魔法", []),
+    ],
+)
+def test_search_short_and_long_words(index, text, expected):
+    _add_all(index)
+    entries, _ = index.search(text=text)
+    assert _paths(entries) == [f"outputs/{i}.png" for i in expected]
+    assert index.count(text=text) == len(expected)
+
+
+def test_search_without_fts(index):
+    _add_all(index)
+    index.fts_enabled = False
+    entries, _ = index.search(text="女の子")
+    assert _paths(entries) == ["outputs/4.png", "outputs/0.png"]
+    # 2文字ずつの索引に含まれても、並びが違えば一致しない
+    assert index.search(text="の女猫")[0] == []
+
+
+def test_search_by_tags_and_text(index):
+    _add_all(index)
+    entries, _ = index.search(tags=["1girl", "Night"], text="金")
+    assert _paths(entries) == ["outputs/1.png"]
+
+
+def test_reindexing_a_path_replaces_its_grams(index):
+    index.add("outputs/a.png", user_input="猫", created_at=1.0)
+    index.add("outputs/a.png", user_input="犬", created_at=2.0)
+    assert index.count(text="猫") == 0
+    assert index.count(text="犬") == 1
+
+
+def test_existing_history_is_backfilled(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    _add_all(HistoryIndex(path))
+    # 1文字・2文字の索引がなかった頃の履歴を再現
+    with sqlite3.connect(path) as conn:
+        conn.execute("DROP TABLE images_ngrams")
+
+    assert HistoryIndex(path).count(text="猫") == 2
+
+
+def test_parse_query_splits_tags_and_text():
+    assert parse_query("1girl 猫、 night,金髪") == (["1girl", "night"], "猫 金髪")
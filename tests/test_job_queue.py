@@ -0,0 +1,90 @@
+"""job_queue.py（SQLiteのジョブキュー）のテスト"""
+
+import pytest
+
+import job_queue
+from job_queue import SQLiteJobQueue
+
+# 取得した時点でリースが切れている（ワーカーのクラッシュを再現）
+EXPIRED = -1
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return SQLiteJobQueue(str(tmp_path / "jobs.sqlite3"), max_attempts=2)
+
+
+def test_claim_in_enqueue_order(queue):
+    first = queue.enqueue({"user_input": "猫"})
+    second = queue.enqueue({"user_input": "犬"})
+
+    job = queue.claim("w1", 60)
+    assert job["id"] == first
+    assert job["payload"] == {"user_input": "猫"}
+    assert job["state"] == job_queue.RUNNING
+    assert job["attempts"] == 1
+
+    # 処理中のジョブは他のワーカーに渡さない
+    assert queue.claim("w2", 60)["id"] == second
+    assert queue.claim("w3", 60) is None
+
+
+def test_expired_lease_is_reclaimed(queue):
+    job_id = queue.enqueue({})
+    queue.claim("crashed", EXPIRED)
+    assert queue.metrics()["expired_leases"] == 1
+
+    job = queue.claim("w2", 60)
+    assert job["id"] == job_id
+    assert job["worker_id"] == "w2"
+    assert job["attempts"] == 2
+
+    # リースを失ったワーカーは延長・完了できない
+    assert not queue.heartbeat(job_id, "crashed", 60)
+    assert not queue.complete(job_id, "crashed", {"image_path": "stale.png"})
+    assert queue.complete(job_id, "w2", {"image_path": "ok.png"})
+    assert queue.get(job_id)["result"] == {"image_path": "ok.png"}
+
+
+def test_heartbeat_keeps_lease(queue):
+    job_id = queue.enqueue({})
+    queue.claim("w1", EXPIRED)
+    assert queue.heartbeat(job_id, "w1", 60, stage="novelai", status_message="生成中")
+    assert queue.claim("w2", 60) is None
+    job = queue.get(job_id)
+    assert (job["stage"], job["status_message"]) == ("novelai", "生成中")
+
+
+def test_max_attempts_marks_job_failed(queue):
+    job_id = queue.enqueue({})
+    queue.claim("crashed-1", EXPIRED)
+    queue.claim("crashed-2", EXPIRED)
+
+    # 上限（2回）に達したリース切れジョブは再取得せず失敗扱い
+    assert queue.claim("w3", 60) is None
+    job = queue.get(job_id)
+    assert job["state"] == job_queue.FAILED
+    assert job["attempts"] == 2
+    assert job["error"]
+
+
+def test_cancelled_job_stops_worker(queue):
+    job_id = queue.enqueue({})
+    queue.claim("w1", 60)
+    assert queue.cancel(job_id)
+    assert not queue.heartbeat(job_id, "w1", 60)
+    assert not queue.cancel(job_id)
+    assert queue.get(job_id)["state"] == job_queue.CANCELLED
+
+
+def test_purge_finished_keeps_recent_and_unfinished_jobs(queue):
+    done = queue.enqueue({})
+    queue.claim("w1", 60)
+    queue.complete(done, "w1", {})
+    queued = queue.enqueue({})
+
+    assert queue.purge_finished(3600) == 0
+    assert queue.purge_finished(-1) == 1
+    assert queue.get(done) is None
+    assert queue.get(queued)["state"] == job_queue.QUEUED
+    assert queue.metrics()["queue_depth"] == 1
@@ -0,0 +1,135 @@
+"""refinement.py（修正の要望の判定・ローカルでの差分作成）のテスト"""
+
+import pytest
+
+from refinement import apply_json_patch, local_edit_patch, looks_like_refinement
+
+PROMPT_DATA = {
+    "characterCount": 1,
+    "prompt": "1girl, library, indoor",
+    "characterPrompts": [
+        {"prompt": "1girl, blonde_hair, blue_eyes, reading", "position": "C3"},
+    ],
+}
+
+TWO_CHARACTERS = {
+    "characterCount": 2,
+    "prompt": "1girl, 1boy, park",
+    "characterPrompts": [
+        {"prompt": "1girl, black_hair", "position": "B3"},
+        {"prompt": "1boy, brown_hair"},
+    ],
+}
+
+
+@pytest.mark.parametrize(
+    "user_input",
+    [
+        "髪を赤にして",
+        "髪を赤にしてください",
+        "背景を夜にして",
+        "左に移動して",
+        "眼鏡を外して",
+        "頭の上にリボンを追加して",
+        "キャラクター2を右に移動してください。",
+        "髪を長くして",
+        "もっと可愛くして",
+        "明るくして",
+        "スカートを短くしてください",
+    ],
+)
+def test_looks_like_refinement(user_input):
+    assert looks_like_refinement(user_input)
+
+
+@pytest.mark.parametrize(
+    "user_input",
+    [
+        "猫耳の女の子を描いてください",
+        "金髪の女の子のイラストを生成して",
+        "魔法使いの絵を作ってください",
+        "制服を着た女子高生が教室で勉強している",
+        "桜の木の下で笑っている女の子を描いて",
+        "髪を赤にして" + "、とても長い説明" * 10,
+    ],
+)
+def test_new_requests_are_not_refinements(user_input):
+    assert not looks_like_refinement(user_input)
+
+
+def _apply(prompt_data, user_input):
+    patch = local_edit_patch(prompt_data, user_input)
+    assert patch is not None
+    return apply_json_patch(prompt_data, patch)
+
+
+def test_local_patch_hair_color():
+    result = _apply(PROMPT_DATA, "髪を赤にして")
+    assert result["characterPrompts"][0]["prompt"] == "1girl, red_hair, blue_eyes, reading"
+    assert result["characterPrompts"][0]["position"] == "C3"
+
+
+def test_local_patch_hair_and_eyes():
+    result = _apply(PROMPT_DATA, "髪を銀色に、目を赤にしてください")
+    assert result["characterPrompts"][0]["prompt"] == "1girl, silver_hair, red_eyes, reading"
+
+
+@pytest.mark.parametrize(
+    "user_input, position",
+    [
+        ("左に移動して", "B3"),
+        ("上に移動して", "C2"),
+        ("真ん中に動かして", "C3"),
+        ("A1に移動して", "A1"),
+    ],
+)
+def test_local_patch_position(user_input, position):
+    result = _apply(PROMPT_DATA, user_input)
+    assert result["characterPrompts"][0]["position"] == position
+
+
+def test_local_patch_targets_character():
+    result = _apply(TWO_CHARACTERS, "2人目を右に移動して")
+    assert result["characterPrompts"][1]["position"] == "D3"
+    assert result["characterPrompts"][0] == TWO_CHARACTERS["characterPrompts"][0]
+
+
+@pytest.mark.parametrize(
+    "user_input",
+    [
+        # 「上に」は移動ではなく位置関係
+        "頭の上にリボンを追加して",
+        "机の上に猫を追加して",
+        # 色の変更以外の要望が含まれる
+        "髪を赤にして、背景を夜にして",
+        "髪を赤にしてツインテールにして",
+        # ローカルでは処理できない要望
+        "背景を夜にして",
+        "笑顔にして",
+    ],
+)
+def test_partial_matches_fall_back_to_llm(user_input):
+    assert local_edit_patch(PROMPT_DATA, user_input) is None
+
+
+def test_ambiguous_target_falls_back_to_llm():
+    # キャラクターが複数いて対象が指定されていない
+    assert local_edit_patch(TWO_CHARACTERS, "髪を赤にして") is None
+
+
+@pytest.mark.parametrize(
+    "patch",
+    [
+        ["bad"],
+        [None],
+        {"op": "replace", "path": "/prompt", "value": "night"},
+        [{"op": "move", "from": "/prompt", "path": "/negative"}],
+        [{"op": "replace", "path": "/characterPrompts/0/position", "value": "Z9"}],
+        [{"op": "replace", "path": "/characterPrompts/0/prompt", "value": ["1girl"]}],
+        [{"op": "replace", "path": "/prompt", "value": 1}],
+        [{"op": "remove", "path": "/characterPrompts/0"}],
+    ],
+)
+def test_invalid_patches_are_rejected(patch):
+    with pytest.raises(ValueError):
+        apply_json_patch(PROMPT_DATA, patch)
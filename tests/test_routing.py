@@ -0,0 +1,24 @@
+"""routing.py（LLMルーティング・構造化プロンプトの検証）のテスト"""
+
+from routing import FAST, FULL, ModelRouter
+
+
+def test_simple_input_routes_to_fast_model():
+    router = ModelRouter(threshold=2)
+    assert router.route("猫の女の子") == FAST
+    assert router.snapshot()["decisions"] == {FAST: 1, FULL: 0}
+
+
+def test_without_fast_model_every_decision_is_full():
+    router = ModelRouter(threshold=2, fast_available=False)
+    assert router.route("猫の女の子") == FULL
+    assert router.snapshot()["decisions"] == {FAST: 0, FULL: 1}
+
+
+def test_decisions_are_logged_periodically(monkeypatch, capsys):
+    monkeypatch.setenv("LLM_ROUTER_LOG_EVERY", "2")
+    router = ModelRouter(threshold=2)
+    router.record_decision(FULL)
+    assert "LLMルーティング集計" not in capsys.readouterr().out
+    router.record_decision(FAST)
+    assert "LLMルーティング集計" in capsys.readouterr().out
@@ -0,0 +1,194 @@
+"""
+ジョブキューから生成ジョブを取り出して処理するワーカープロセス
+
+UI（main.py）を JOB_QUEUE_ENABLED=true で起動すると、生成リクエストは
+ジョブキューに投入される。このワーカーを1つ以上起動して処理する。
+
+使い方:
+    python worker.py --workers 2
+    python worker.py --metrics   # キューの深さ等を表示して終了
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from cancellation import CancellationToken, RequestCancelledError
+import job_queue
+
+
+class JobWorker:
+    """ジョブを1件ずつ取得し、ChatGPT → NovelAI → 保存 の順に処理する"""
+
+    def __init__(self, queue: job_queue.SQLiteJobQueue, worker_id: str, service):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.service = service
+        self.lease_seconds = float(os.getenv("JOB_LEASE_SECONDS", 60))
+        self.heartbeat_interval = float(os.getenv("JOB_HEARTBEAT_INTERVAL", 2))
+        self.poll_interval = float(os.getenv("JOB_POLL_INTERVAL", 0.5))
+        # 終了したジョブを残す秒数（0以下で削除しない）
+        self.retention_seconds = float(os.getenv("JOB_RETENTION_SECONDS", 86400))
+        self.purge_interval = float(os.getenv("JOB_PURGE_INTERVAL", 600))
+        self._last_purge = None
+
+    def _heartbeat_loop(self, job_id: str, token: CancellationToken, stop: threading.Event):
+        """リースを延長し続け、ジョブのキャンセル・リース喪失を検知したら処理を中断"""
+        while not stop.wait(self.heartbeat_interval):
+            if not self.queue.heartbeat(job_id, self.worker_id, self.lease_seconds):
+                token.cancel("job_cancelled")
+                return
+
+    def _update(self, job_id: str, token: CancellationToken, stage: str, message: str):
+        token.enter_stage(stage)
+        if not self.queue.heartbeat(
+            job_id, self.worker_id, self.lease_seconds, stage=stage, status_message=message
+        ):
+            token.cancel("job_cancelled")
+            token.raise_if_cancelled()
+
+    def process(self, job: dict):
+        """ジョブを1件処理"""
+        job_id = job["id"]
+        payload = job["payload"]
+        token = CancellationToken()
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat_loop, args=(job_id, token, stop), daemon=True
+        )
+        heartbeat.start()
+
+        try:
+            prompt_data = payload.get("prompt_data")
+            if prompt_data is None:
+                base_prompt_data = payload.get("base_prompt_data")
+                if base_prompt_data is not None:
+                    message = "✏️ 前回のプロンプトを修正中..."
+                else:
+                    message = "🤖 ChatGPTでイラスト内容を補完中..."
+                self._update(job_id, token, "chatgpt", message)
+                prompt_data = self.service.build_prompt_data(
+                    payload["user_input"],
+                    cancel_token=token,
+                    base_prompt_data=base_prompt_data,
+                )
+
+            if not self.service.novelai:
+                raise RuntimeError("NovelAI APIが利用できません。")
+
+            self._update(job_id, token, "novelai", "🎨 NovelAI v4.5で画像生成中...")
+            image_data = self.service.novelai.generate_image(prompt_data, cancel_token=token)
+            if not image_data:
+                raise RuntimeError("画像生成に失敗しました。APIキーや設定を確認してください。")
+
+            self._update(job_id, token, "saving", "💾 画像を保存中...")
+            image_path = self.service.save_generated_image(
+                image_data,
+                name_suffix=job_id[:8],
+                metadata=prompt_data,
+                user_input=payload.get("user_input", ""),
+            )
+            if not image_path:
+                raise RuntimeError("画像の保存に失敗しました")
+
+            self.queue.complete(
+                job_id,
+                self.worker_id,
+                {"prompt_data": prompt_data, "image_path": os.path.abspath(image_path)},
+            )
+            print(f"✅ [{self.worker_id}] ジョブ完了: {job_id}")
+        except RequestCancelledError as e:
+            print(f"🛑 [{self.worker_id}] ジョブをキャンセルしました: {job_id} (段階: {e.stage})")
+        except Exception as e:
+            self.queue.fail(job_id, self.worker_id, str(e))
+            print(f"❌ [{self.worker_id}] ジョブ失敗: {job_id}: {e}")
+        finally:
+            stop.set()
+            heartbeat.join()
+
+    def purge_if_due(self):
+        """前回の削除からJOB_PURGE_INTERVAL秒経っていれば、保持期間を過ぎたジョブを削除"""
+        if self.retention_seconds <= 0:
+            return
+        now = time.monotonic()
+        if self._last_purge is not None and now - self._last_purge < self.purge_interval:
+            return
+        self._last_purge = now
+        deleted = self.queue.purge_finished(self.retention_seconds)
+        if deleted:
+            print(f"🧹 [{self.worker_id}] 終了したジョブを{deleted}件削除しました")
+
+    def run(self, stop: threading.Event = None):
+        """ジョブを取得して処理し続ける"""
+        print(f"👷 ワーカー起動: {self.worker_id}")
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            job = self.queue.claim(self.worker_id, self.lease_seconds)
+            if job is None:
+                # 待機中のジョブがない間に古いジョブを掃除する
+                self.purge_if_due()
+                stop.wait(self.poll_interval)
+                continue
+            print(f"📥 [{self.worker_id}] ジョブ取得: {job['id']} (試行{job['attempts']}回目)")
+            self.process(job)
+
+
+def run_worker(index: int):
+    """ワーカープロセスのエントリーポイント"""
+    from main import IllustrationChatService
+
+    service = IllustrationChatService(background=False, use_job_queue=False)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{index}"
+    try:
+        JobWorker(job_queue.SQLiteJobQueue(), worker_id, service).run()
+    except KeyboardInterrupt:
+        # 処理中のジョブはリース切れ後に他のワーカーが再取得する
+        print(f"👋 ワーカー停止: {worker_id}")
+
+
+def print_metrics():
+    """キューの状態を表示"""
+    metrics = job_queue.SQLiteJobQueue().metrics()
+    print(json.dumps(metrics, ensure_ascii=False, indent=2))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="イラスト生成ジョブのワーカー")
+    parser.add_argument("--workers", type=int, default=1, help="起動するワーカープロセス数")
+    parser.add_argument(
+        "--metrics", action="store_true", help="キューの深さ等を表示して終了"
+    )
+    args = parser.parse_args()
+
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    if args.metrics:
+        print_metrics()
+        return
+
+    if args.workers == 1:
+        run_worker(0)
+        return
+
+    processes = [
+        multiprocessing.Process(target=run_worker, args=(i,), name=f"worker-{i}")
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join(timeout=10)
+
+
+if __name__ == "__main__":
+    main()